@@ -1,4 +1,5 @@
 from plumbum import cli
+from walt.client.agent import WalTAgent, get_agent_socket_path
 from walt.client.link import ClientToServerLink
 from walt.client.interactive import run_sql_prompt
 from walt.client.auth import get_auth_conf
@@ -50,3 +51,47 @@ class WalTUpdateHubMeta(WalTApplication):
 class WalTRescanHubAccount(WalTUpdateHubMeta):
     """alias to 'update-hub-meta' subcommand"""
     pass
+
+@WalTAdvanced.subcommand("agent")
+class WalTAdvancedAgent(WalTApplication):
+    """keep server sessions open to speed up walt commands"""
+    def main(self):
+        socket_path = get_agent_socket_path()
+        print('Agent listening on %s (press ctrl-C to stop).' % socket_path)
+        try:
+            WalTAgent(socket_path).run()
+        except RuntimeError as e:
+            print(e)
+        except KeyboardInterrupt:
+            print()
+
+@WalTAdvanced.subcommand("evloop-stats")
+class WalTAdvancedEvloopStats(WalTApplication):
+    """show event loop statistics of the server main thread"""
+    def main(self):
+        with ClientToServerLink() as server:
+            stats = server.get_evloop_stats()
+        if stats is None:
+            print('Event loop stats are not enabled on the server ' + \
+                  '(cf. "evloop" section of /etc/walt/server.conf).')
+            return
+        print('slow events (> %ss): %d' % (stats['slow_threshold'], stats['slow_events']))
+        print_histogram('poll wait (s)', stats['poll_wait'])
+        print_histogram('ready fds per poll', stats['ready_fds'])
+        print_histogram('planned event lateness (s)', stats['planned_event_lateness'])
+        for name, histogram in sorted(stats['handlers'].items()):
+            print_histogram('handler %s (s)' % name, histogram)
+        for name, histogram in sorted(stats['planned_handlers'].items()):
+            print_histogram('planned event %s (s)' % name, histogram)
+
+def print_histogram(title, histogram):
+    count = histogram['count']
+    if count == 0:
+        return
+    print('%s: count=%d avg=%.6g max=%.6g' % (title, count,
+                histogram['total'] / count, histogram['max']))
+    for bound, bucket_count in histogram['buckets']:
+        if bucket_count > 0:
+            if bound is None:
+                bound = 'inf'
+            print('    <= %-8s %d' % (bound, bucket_count))
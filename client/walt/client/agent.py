@@ -0,0 +1,231 @@
+#!/usr/bin/env python
+import os, socket, stat, tempfile
+from time import time
+from walt.client.config import conf
+from walt.common.codec import CODEC_VERSION, FRAME_HEADER, encode_frame, decode_payload
+from walt.common.constants import WALT_SERVER_DAEMON_PORT
+from walt.common.evloop import EventLoop
+from walt.common.io import read_exactly, write_all
+from walt.common.tcp import Requests, get_peer_uid
+
+# The walt client agent (cf. 'walt advanced agent') keeps API sessions
+# with the server open, and lends them to walt commands connecting on
+# its unix socket. This saves a TCP connection and the creation of
+# a server-side API session for each command.
+# Commands speak the same protocol with the agent and with the server
+# (with the binary codec only, cf. ServerAPIConnection.connect()),
+# the agent just relays messages, and it tracks when API calls are
+# running in order to know if a session can be reused.
+# When a command disconnects, the agent calls reset_session() on the
+# server side of the session, before keeping it for another command.
+# Scope: the agent is a pool of sessions, it does not multiplex several
+# commands (or API calls and data streams) over one connection with
+# channel ids. Each command gets a whole session (and its TCP connection)
+# for its lifetime, and the pool opens a new one if none is available.
+# Logs, transfers and prompts still use their own connections, as with
+# no agent.
+
+AGENT_IDLE_TIMEOUT = 600        # close sessions unused for this time
+AGENT_CLEANUP_PERIOD = 60
+
+# The socket is created in a private directory (mode 0700, owned by the
+# user), thus other users cannot create it first and impersonate the
+# agent. Commands also check that the socket and the agent process belong
+# to the user (cf. ServerAPIConnection.connect_agent()), and the agent
+# refuses commands of other users.
+def get_agent_socket_dir():
+    run_dir = os.environ.get('XDG_RUNTIME_DIR')
+    if run_dir is None:
+        return os.path.join(tempfile.gettempdir(), 'walt-agent-%d' % os.getuid())
+    return os.path.join(run_dir, 'walt-agent')
+
+def get_agent_socket_path():
+    return os.path.join(get_agent_socket_dir(), 'agent.sock')
+
+def is_private_dir(path):
+    st = os.lstat(path)
+    return stat.S_ISDIR(st.st_mode) and st.st_uid == os.getuid() and \
+            stat.S_IMODE(st.st_mode) & 0o077 == 0
+
+def prepare_agent_socket_dir(socket_path):
+    socket_dir = os.path.dirname(socket_path)
+    try:
+        os.mkdir(socket_dir, 0o700)
+    except FileExistsError:
+        pass
+    if not is_private_dir(socket_dir):
+        raise RuntimeError('%s should be a directory owned by the user, with mode 0700.' % \
+                            socket_dir)
+
+# returns the frame (raw bytes) and the decoded message,
+# or (None, None) if the connection is closed or broken.
+def read_frame(sock_file):
+    try:
+        header = read_exactly(sock_file, FRAME_HEADER.size)
+        if header is None:
+            return None, None
+        payload = read_exactly(sock_file, FRAME_HEADER.unpack(header)[0])
+        if payload is None:
+            return None, None
+        return header + payload, decode_payload(payload)
+    except Exception:
+        return None, None
+
+def send_frame(sock_file, frame):
+    try:
+        write_all(sock_file, frame)
+        return True
+    except OSError:
+        return False
+
+class ServerSession(object):
+    def __init__(self, agent, target_api):
+        self.agent = agent
+        self.target_api = target_api
+        self.sock = socket.create_connection((conf['server'], WALT_SERVER_DAEMON_PORT))
+        self.sock_file = self.sock.makefile('rwb', 0)
+        self.sock_file.write(b'%d\n%s\n%d\n' % (Requests.REQ_API_SESSION_BINARY,
+                                target_api.encode('UTF-8'), CODEC_VERSION))
+        self.version_line = self.sock_file.readline()
+        int(self.version_line.strip())  # ValueError if codec is not supported
+        self.client = None      # command currently using this session
+        self.running_calls = 0  # API calls sent and not returned yet
+        self.last_used = time()
+    def fileno(self):
+        return self.sock.fileno()
+    def handle_event(self, ts):
+        frame, event = read_frame(self.sock_file)
+        if frame is None or self.client is None:
+            return False    # session closed by the server, or unexpected data
+        if event[0] in ('RESULT', 'EXCEPTION', 'RESULT_ID', 'EXCEPTION_ID'):
+            self.running_calls -= 1     # end of API call
+        if not self.client.send(frame):
+            return False
+    def send(self, frame):
+        return send_frame(self.sock_file, frame)
+    # let the server cleanup this session before it is reused
+    def reset(self):
+        if not self.send(encode_frame(('API_CALL', 'reset_session', (), {}))):
+            return False
+        while True:
+            frame, event = read_frame(self.sock_file)
+            if frame is None:
+                return False
+            if event[0] == 'API_CALL':
+                # the server calls the client (e.g. to write on stdout),
+                # but there is no client anymore
+                self.send(encode_frame(('RESULT', None)))
+                continue
+            # older servers do not implement reset_session()
+            return event[0] == 'RESULT'
+    def close(self):
+        self.agent.forget_session(self)
+        client, self.client = self.client, None
+        if client is not None:
+            client.server = None
+            self.agent.ev_loop.remove_listener(client)
+        self.sock.close()
+
+class CommandConnection(object):
+    def __init__(self, agent, sock):
+        self.agent = agent
+        self.sock = sock
+        self.sock_file = sock.makefile('rwb', 0)
+        self.server = None
+    def fileno(self):
+        return self.sock.fileno()
+    def handle_event(self, ts):
+        if self.server is None:
+            return self.start_session()
+        frame, event = read_frame(self.sock_file)
+        if frame is None:
+            return False
+        if event[0] in ('API_CALL', 'API_CALL_ID'):
+            self.server.running_calls += 1
+        if not self.server.send(frame):
+            return False
+    def start_session(self):
+        try:
+            req_id = Requests.read_id(self.sock_file)
+            target_api = self.sock_file.readline().decode('UTF-8').strip()
+            codec_version = int(self.sock_file.readline().strip())
+            if req_id != Requests.REQ_API_SESSION_BINARY or \
+                        codec_version != CODEC_VERSION:
+                return False    # the command will connect to the server directly
+            server = self.agent.get_session(target_api)
+        except (ValueError, OSError) as e:
+            print('Could not start session: %s' % e)
+            return False
+        self.server, server.client = server, self
+        return self.send(server.version_line)
+    def send(self, frame):
+        return send_frame(self.sock_file, frame)
+    def close(self):
+        server, self.server = self.server, None
+        if server is not None:
+            server.client = None
+            self.agent.release_session(server)
+        self.sock.close()
+
+class WalTAgent(object):
+    def __init__(self, socket_path):
+        self.socket_path = socket_path
+        self.ev_loop = EventLoop()
+        self.idle_sessions = {}     # target_api -> [ session, ... ]
+        self.sock = None
+        prepare_agent_socket_dir(socket_path)
+        if os.path.exists(socket_path):
+            os.unlink(socket_path)  # stale socket
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.bind(socket_path)
+        os.chmod(socket_path, 0o600)
+        self.sock.listen(16)
+    def fileno(self):
+        return self.sock.fileno()
+    # a walt command is connecting
+    def handle_event(self, ts):
+        conn, addr = self.sock.accept()
+        peer_uid = get_peer_uid(conn)
+        if peer_uid is not None and peer_uid != os.getuid():
+            conn.close()    # command of another user
+            return
+        self.ev_loop.register_listener(CommandConnection(self, conn))
+    def get_session(self, target_api):
+        sessions = self.idle_sessions.get(target_api, [])
+        if len(sessions) > 0:
+            return sessions.pop()
+        session = ServerSession(self, target_api)
+        self.ev_loop.register_listener(session)
+        return session
+    def release_session(self, session):
+        if session.running_calls == 0 and session.reset():
+            session.last_used = time()
+            self.idle_sessions.setdefault(session.target_api, []).append(session)
+        else:
+            # the command was interrupted during an API call
+            self.ev_loop.remove_listener(session)
+    def forget_session(self, session):
+        sessions = self.idle_sessions.get(session.target_api, [])
+        if session in sessions:
+            sessions.remove(session)
+    # close sessions unused for a long time
+    def handle_planned_event(self):
+        limit = time() - AGENT_IDLE_TIMEOUT
+        for sessions in list(self.idle_sessions.values()):
+            for session in list(sessions):
+                if session.last_used < limit:
+                    self.ev_loop.remove_listener(session)
+    def run(self):
+        self.ev_loop.register_listener(self)
+        self.ev_loop.plan_event(ts = time(), target = self,
+                                repeat_delay = AGENT_CLEANUP_PERIOD)
+        try:
+            self.ev_loop.loop()
+        finally:
+            self.close()
+    def close(self):
+        if self.sock is not None:
+            self.sock.close()
+            self.sock = None
+            if os.path.exists(self.socket_path):
+                os.unlink(self.socket_path)
@@ -2,7 +2,7 @@
 from walt.client.config import conf
 from select import select
 from walt.common.constants import WALT_SERVER_TCP_PORT
-from walt.common.io import read_and_copy
+from walt.common.io import StreamRelay
 from walt.common.tcp import Requests, write_pickle, client_sock_file, \
                             server_socket, SmartSocketFile
 
@@ -14,10 +14,11 @@ class TCPExposer:
             node_port = node_port
         )
         self.associations = {}
+        self.relays = {}    # input channel -> relay, for running directions
     def run(self):
         self.local_server_s = server_socket(self.local_port)
         while True:
-            read_socks = list(self.associations.keys()) + [ self.local_server_s ]
+            read_socks = list(self.relays.keys()) + [ self.local_server_s ]
             select_args = [ read_socks, [], read_socks ]
             rlist, wlist, elist = select(*select_args)
             if len(elist) > 0 or len(rlist) == 0:
@@ -27,12 +28,21 @@ class TCPExposer:
                 if self.event_on_server_s() == False:
                     break
             else:
-                paired_sock = self.associations[sock_r]
-                if read_and_copy(sock_r, paired_sock) == False:
-                    for s in (sock_r, paired_sock):
-                        s.close()
-                    del self.associations[sock_r]
-                    del self.associations[paired_sock]
+                if self.relays[sock_r].relay() == False:
+                    self.relay_ended(sock_r)
+    def relay_ended(self, sock_r):
+        # forward the end of input as a half-close: data may still
+        # flow the other way.
+        relay = self.relays.pop(sock_r)
+        relay.shutdown_output()
+        relay.close()
+        paired_sock = self.associations[sock_r]
+        if paired_sock not in self.relays:
+            # both directions are over
+            for s in (sock_r, paired_sock):
+                s.close()
+            del self.associations[sock_r]
+            del self.associations[paired_sock]
     def open_channel_to_node(self):
         # connect
         server_host = conf['server']
@@ -59,8 +69,12 @@ class TCPExposer:
         client_channel = SmartSocketFile(conn_s)
         self.associations[client_channel] = node_channel
         self.associations[node_channel] = client_channel
+        self.relays[client_channel] = StreamRelay(client_channel, node_channel)
+        self.relays[node_channel] = StreamRelay(node_channel, client_channel)
     def close(self):
         for f1, f2 in self.associations.items():
             f1.close()
             f2.close()
+        for relay in self.relays.values():
+            relay.close()
         self.local_server_s.close()
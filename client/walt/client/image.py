@@ -117,14 +117,19 @@ class WalTImageCp(WalTApplication):
             info = server.validate_image_cp(src, dst)
             if info == None:
                 return
-            session_info = server.create_image_shell_session(
-                            info['image_name'], 'file transfer')
-            if session_info == None:
-                return  # issue already reported
-            session_id, image_fullname, container_name, default_new_name = \
-                            session_info
-            info.update(image_fullname = image_fullname,
-                        container_name = container_name)
+            if info['client_operand_index'] == 0:
+                # client -> image: the server will receive files in a
+                # container, and commit it in the end.
+                session_info = server.create_image_shell_session(
+                                info['image_name'], 'file transfer')
+                if session_info == None:
+                    return  # issue already reported
+                session_id, image_fullname, container_name, default_new_name = \
+                                session_info
+                info.update(image_fullname = image_fullname,
+                            container_name = container_name)
+            # (image -> client: the server reads the image filesystem
+            # directly, no need for a container)
             try:
                 run_transfer_with_image(**info)
                 if info['client_operand_index'] == 0:
@@ -1,5 +1,6 @@
 #!/usr/bin/env python
 import sys
+from walt.client.agent import get_agent_socket_path
 from walt.client.config import conf
 from walt.client.filesystem import Filesystem
 from walt.common.api import api, api_expose_method, api_expose_attrs
@@ -52,4 +53,5 @@ class ClientToServerLink(ServerAPILink):
     service = WaltClientService()
     def __init__(self):
         ServerAPILink.__init__(self,
-                conf['server'], 'CSAPI', ClientToServerLink.service)
+                conf['server'], 'CSAPI', ClientToServerLink.service,
+                get_agent_socket_path())
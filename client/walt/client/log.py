@@ -1,7 +1,7 @@
 import sys, re, datetime, pickle
 from walt.common.constants import WALT_SERVER_TCP_PORT
-from walt.common.tcp import read_pickle, write_pickle, client_sock_file, \
-                            Requests
+from walt.common.logs import get_logs_reader
+from walt.common.tcp import write_pickle, client_sock_file, Requests
 from plumbum import cli
 from walt.client.application import WalTCategoryApplication, WalTApplication
 from walt.client.config import conf
@@ -27,11 +27,16 @@ def validate_checkpoint_name(name):
 class LogsFlowFromServer(object):
     def __init__(self, walt_server_host):
         self.f = client_sock_file(walt_server_host, WALT_SERVER_TCP_PORT)
+        self.reader = None
     def read_log_record(self):
-        return read_pickle(self.f)
+        return self.reader.read_record()
     def request_log_dump(self, **kwargs):
         Requests.send_id(self.f, Requests.REQ_DUMP_LOGS)
-        write_pickle(kwargs, self.f)
+        write_pickle(dict(framing = 'compact', **kwargs), self.f)
+        # older servers ignore the 'framing' parameter
+        self.reader = get_logs_reader(self.f)
+        if self.reader is None:
+            raise Exception('Unexpected answer from server.')
     def close(self):
         self.f.close()
 
@@ -49,8 +49,11 @@ class WalTNode(WalTCategoryApplication):
                 sys.stderr.write(
                     'Error: this command must target 1 node only.\n')
                 return
+            # preparing ssh access does not depend on nodes being booted,
+            # thus we do not wait for the end of wait_for_nodes() to request it
+            ssh_ready = server.pipelined().prepare_ssh_access(node_set)
             WalTNode.wait_for_nodes(server, node_set)
-            server.prepare_ssh_access(node_set)
+            ssh_ready.result()
         if nodes_ip:
             for ip in nodes_ip:
                 if startup_msg:
@@ -223,7 +226,7 @@ class WalTNodeRun(WalTApplication):
 
 @WalTNode.subcommand("cp")
 class WalTNodeCp(WalTApplication):
-    """transfer files/dirs (client machine <-> node)"""
+    """transfer files/dirs (client machine <-> node(s))"""
     def main(self, src, dst):
         with ClientToServerLink() as server:
             info = server.validate_node_cp(src, dst)
@@ -1,4 +1,4 @@
-import sys, os
+import sys, os, time
 from multiprocessing import Process, Queue
 from queue import Empty
 
@@ -33,11 +33,23 @@ def choose(msg='possible values:', **args):
 def confirm(msg = 'Are you sure?', komsg = 'Aborted.'):
     return yes_or_no(msg, komsg = komsg)
 
+def format_size(size):
+    for unit in ('B', 'KiB', 'MiB', 'GiB'):
+        if size < 1024 or unit == 'GiB':
+            break
+        size /= 1024.0
+    if unit == 'B':
+        return '%d%s' % (size, unit)
+    return '%.1f%s' % (size, unit)
+
+PROGRESS_UPDATE_PERIOD = 0.2
+
 class ProgressMessageThread(Process):
     def __init__(self, message):
         Process.__init__(self)
         self.message = message
         self.queue = Queue()
+        self.last_progress_update = 0
     def __enter__(self):
         self.start()
         return self
@@ -49,19 +61,24 @@ class ProgressMessageThread(Process):
         sys.stdout.flush()
     def run(self):
         idx = 0
+        progress = ''
         try:
             while True:
-                self.print_status("\\|/-"[idx])
+                self.print_status("\\|/-"[idx] + progress)
                 idx = (idx+1) % 4
                 try:
                     req = self.queue.get(block = True, timeout = 0.2)
                 except Empty:
                     continue
                 # there is input in the queue
+                if req[0] == 2:
+                    # progress update
+                    progress = ' ' + req[1]
+                    continue
                 if req[0] == 0:
                     # regular end: we should notify that we
                     # are done and stop
-                    self.print_status("done", '\n')
+                    self.print_status("done".ljust(len(progress)), '\n')
                 else:
                     # interruption: stop and print the provided msg.
                     sys.stdout.write("%s\n" % req[1])
@@ -71,4 +88,18 @@ class ProgressMessageThread(Process):
             self.queue.put(0)
     def interrupt(self, msg):
         self.queue.put((1, msg))
+    # show the number of bytes transfered (and the percentage if the
+    # total size is known), with an optional note.
+    def set_progress(self, done, total = None, note = None, force = False):
+        t = time.time()
+        if not force and t - self.last_progress_update < PROGRESS_UPDATE_PERIOD:
+            return
+        self.last_progress_update = t
+        progress = format_size(done)
+        if total:
+            progress += ' / %s (%d%%)' % (format_size(total), min(100, done * 100 // total))
+        if note:
+            progress += ' - ' + note
+        # pad, in case the new status line is shorter than the previous one
+        self.queue.put((2, progress.ljust(40)))
 
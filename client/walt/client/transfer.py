@@ -1,9 +1,13 @@
 from walt.client.config import conf
 from walt.client.tools import ProgressMessageThread
+from walt.common.chunked import CHUNK_HEADER, CHUNK_SIZE, COMPRESSIONS, FINGERPRINT, \
+                                 compress_chunk
+from walt.common.io import write_all
 from walt.common.tcp import write_pickle, client_sock_file, \
                             Requests
 from walt.common.constants import WALT_SERVER_TCP_PORT
-import os, tarfile, socket
+import os, tarfile, time, uuid, zlib
+from collections import deque
 
 def run_transfer_with_image(client_operand_index, **kwargs):
     if client_operand_index == 0:
@@ -23,31 +27,248 @@ def run_transfer_with_node(client_operand_index, **kwargs):
                  client_operand_index = client_operand_index,
                  **kwargs)
 
-class SmartWriter:
-    """SmartWriter class allows to write data on a socket while
-       still keeping track of any data (typically error message)
-       sent the other way."""
-    def __init__(self, sock_file):
+# when an upload is interrupted, we try to reconnect and resume it
+# (cf. walt/common/chunked.py)
+UPLOAD_MAX_RETRIES = 10
+UPLOAD_RETRY_DELAY = 3
+
+# compression of uploads, depending on the throughput of the link with
+# the server (cf. ThroughputMeter):
+# (min throughput in bytes/s, compression, level)
+UPLOAD_COMPRESSION_LEVELS = (
+    (50000000, 'none', 0),  # local network
+    (10000000, 'zlib', 1),
+    (1000000,  'zlib', 6),
+    (None,     'lzma', 1)   # very slow link
+)
+# compression used until the throughput is known
+UPLOAD_INITIAL_COMPRESSION = ('zlib', 1)
+# minimal duration of a throughput measure (seconds)
+UPLOAD_MIN_MEASURE_TIME = 0.2
+
+def choose_compression(throughput, accepted):
+    for min_throughput, compression, level in UPLOAD_COMPRESSION_LEVELS:
+        if compression not in accepted:
+            continue
+        if min_throughput is None or throughput >= min_throughput:
+            return compression, level
+    return 'none', 0
+
+class ThroughputMeter:
+    """ThroughputMeter class estimates the throughput of the link with
+       the server, given the size of the chunks sent and the time when
+       the server acknowledges them. The measure starts at the first ACK,
+       and the time spent compressing chunks is not counted (otherwise a
+       slow compression would look like a slow link)."""
+    def __init__(self):
+        self.pending = deque()  # (end offset, payload size) of sent chunks
+        self.start = None       # time of the first ACK
+        self.end = None         # time of the last ACK
+        self.busy = 0           # time spent compressing since self.start
+        self.size = 0           # payload bytes acknowledged since self.start
+    def chunk_sent(self, end_offset, payload_size, compress_time):
+        self.pending.append((end_offset, payload_size))
+        if self.start is not None:
+            self.busy += compress_time
+    def acked(self, offset):
+        size = 0
+        while len(self.pending) > 0 and self.pending[0][0] <= offset:
+            size += self.pending.popleft()[1]
+        if self.start is None:
+            self.start = time.time()
+        else:
+            self.end = time.time()
+            self.size += size
+    # returns the throughput in bytes/s, or None if not known yet
+    def get_throughput(self):
+        if self.end is None or self.end - self.start < UPLOAD_MIN_MEASURE_TIME:
+            return None
+        return self.size / max(self.end - self.start - self.busy, 0.001)
+
+# returns the size of the files in <path>, and the maximal size of the
+# tar stream: each entry takes a header (counted as 3 blocks, in case of
+# long names) and its data padded to a block boundary, and the archive
+# ends with 2 blocks, padded to the record size.
+TAR_HEADER_MAX_SIZE = 3 * tarfile.BLOCKSIZE
+
+def get_tree_sizes(path):
+    def pad(size):
+        return -(-size // tarfile.BLOCKSIZE) * tarfile.BLOCKSIZE
+    if not os.path.isdir(path):
+        size = os.path.getsize(path)
+        tar_size = TAR_HEADER_MAX_SIZE + pad(size)
+    else:
+        size, tar_size = 0, TAR_HEADER_MAX_SIZE
+        for dirpath, dirnames, filenames in os.walk(path, followlinks=True):
+            tar_size += len(dirnames) * TAR_HEADER_MAX_SIZE
+            for name in filenames:
+                tar_size += TAR_HEADER_MAX_SIZE
+                try:
+                    file_size = os.path.getsize(os.path.join(dirpath, name))
+                except OSError:
+                    continue
+                size += file_size
+                tar_size += pad(file_size)
+    tar_size += 2 * tarfile.BLOCKSIZE + tarfile.RECORDSIZE
+    return size, tar_size
+
+class UploadEnded(Exception):
+    pass
+
+class ChunkedWriter:
+    """ChunkedWriter class cuts the tar stream into chunks and sends
+       them, skipping what the server already received, and handles
+       the messages sent back by the server. The compression of chunks
+       is adjusted depending on the throughput measured."""
+    def __init__(self, sock_file, start_offset, accepted, compression,
+                 level, progress):
+        self.sock_file = sock_file
+        self.start_offset = start_offset
+        self.accepted = accepted    # compressions accepted by the server
+        self.compression = compression
+        self.level = level
+        self.meter = ThroughputMeter()
+        self.progress = progress
+        self.offset = 0             # offset of self.chunk in the tar stream
+        self.chunk = bytearray()
+        self.prefix_crc = 0         # crc32 of the skipped part of the stream
+        self.fingerprint_sent = False
+        self.acked = start_offset   # data received by the server
+        self.replies = b''
+        self.end_size = None        # size of the output of the server
+    def write(self, data):
+        if self.end_size is not None:
+            raise UploadEnded()     # the receiving process ended
+        if self.offset < self.start_offset:
+            # the server already has this part
+            skipped = min(len(data), self.start_offset - self.offset)
+            self.prefix_crc = zlib.crc32(data[:skipped], self.prefix_crc)
+            self.offset += skipped
+            data = data[skipped:]
+        if self.offset == self.start_offset and not self.fingerprint_sent:
+            self.send_fingerprint()
+        self.chunk += data
+        while len(self.chunk) >= CHUNK_SIZE:
+            self.send_chunk(bytes(self.chunk[:CHUNK_SIZE]))
+            del self.chunk[:CHUNK_SIZE]
+    # let the server check we generate the same tar stream as before
+    def send_fingerprint(self):
+        write_all(self.sock_file, FINGERPRINT.pack(self.offset, self.prefix_crc))
+        self.fingerprint_sent = True
+    def send_chunk(self, chunk):
+        throughput = self.meter.get_throughput()
+        if throughput is not None:
+            self.compression, self.level = choose_compression(
+                                                throughput, self.accepted)
+        t0 = time.time()
+        payload = compress_chunk(self.compression, self.level, chunk)
+        compress_time = time.time() - t0
+        write_all(self.sock_file, CHUNK_HEADER.pack(
+                self.offset, len(chunk), len(payload), zlib.crc32(chunk),
+                COMPRESSIONS.index(self.compression)))
+        write_all(self.sock_file, payload)
+        self.offset += len(chunk)
+        self.meter.chunk_sent(self.offset, len(payload), compress_time)
+        self.read_replies(block = False)
+    def read_replies(self, block):
+        if block:
+            data = self.sock_file.read(4096)
+            if data == b'':
+                raise ConnectionError('Connection lost.')
+        else:
+            data = self.sock_file.read_available()
+        self.replies += data
+        while self.end_size is None and b'\n' in self.replies:
+            line, self.replies = self.replies.split(b'\n', 1)
+            words = line.split()
+            if words[0] == b'ACK':
+                self.acked = int(words[1])
+                self.meter.acked(self.acked)
+                self.progress(self.acked)
+            elif words[0] == b'RESTART':
+                self.acked = 0
+                raise ConnectionError('Files were modified.')
+            elif words[0] == b'END':
+                self.end_size = int(words[1])
+    # send the end of the stream (unless the receiving process already
+    # ended) and return the output of the receiving process
+    def finish(self):
+        if self.end_size is None:
+            if not self.fingerprint_sent:
+                # the stream is shorter than what the server received
+                self.send_fingerprint()
+            if len(self.chunk) > 0:
+                self.send_chunk(bytes(self.chunk))
+                self.chunk = bytearray()
+            self.send_chunk(b'')    # end of transfer
+        while self.end_size is None or len(self.replies) < self.end_size:
+            self.read_replies(block = True)
+        return self.replies[:self.end_size].decode('utf-8').strip()
+
+class ProgressReader:
+    """ProgressReader class counts bytes read from a socket."""
+    def __init__(self, sock_file, progress):
         self.sock_file = sock_file
-        self.buf_out = b''
-    def write(self, s):
-        self.buf_out += self.sock_file.read_available()
-        return self.sock_file.write(s)
-    def wait_remote_close(self):
-        while True:
-            c = self.sock_file.read(1)
-            if c == b'':
-                break
-            self.buf_out += c
-    def shutdown_write(self):
-        self.flush()
-        self.sock_file.shutdown(socket.SHUT_WR)
-    def flush(self):
-        self.sock_file.flush()
-    def close(self):
-        self.sock_file.close()
-    def get_msg(self):
-        return self.buf_out.decode('utf-8').strip()
+        self.progress = progress
+        self.count = 0
+    def read(self, size):
+        data = self.sock_file.read(size)
+        self.count += len(data)
+        self.progress(self.count)
+        return data
+
+def start_transfer(sock_file, req_id, params):
+    # send the request id
+    Requests.send_id(sock_file, req_id)
+    # wait for the READY message from the server
+    sock_file.readline()
+    # write the parameters
+    write_pickle(params, sock_file)
+
+def upload(req_id, params, src_path, tmp_name, message_thread):
+    total, max_tar_size = get_tree_sizes(src_path)
+    def progress(done, note = None):
+        message_thread.set_progress(done, total, note, force = note is not None)
+    # the server checks it has enough space for broadcast uploads
+    params.update(chunked = True, transfer_id = uuid.uuid4().hex,
+                  size = max_tar_size)
+    retries = 0
+    writer = None
+    compression, level = UPLOAD_INITIAL_COMPRESSION
+    while True:
+        f = None
+        try:
+            f = client_sock_file(conf['server'], WALT_SERVER_TCP_PORT)
+            start_transfer(f, req_id, params)
+            # the server tells where we should start, and the compressions
+            # it accepts
+            words = f.readline().split()
+            offset = int(words[1])
+            accepted = words[2].decode('ascii').split(',')
+            if writer is not None:
+                # when resuming, keep the compression chosen before
+                compression, level = writer.compression, writer.level
+            if compression not in accepted:
+                compression, level = 'none', 0
+            writer = ChunkedWriter(f, offset, accepted, compression, level,
+                                   progress)
+            try:
+                with tarfile.open(mode='w|', fileobj=writer, dereference=True) as archive:
+                    archive.add(src_path, arcname=tmp_name)
+            except UploadEnded:
+                pass    # the receiving process failed, get its output
+            msg = writer.finish()
+        except (OSError, IndexError, ValueError):
+            if f is not None:
+                f.close()
+            if writer is None or retries == UPLOAD_MAX_RETRIES:
+                raise   # could not start, or too many failures
+            retries += 1
+            progress(writer.acked, 'connection lost, resuming')
+            time.sleep(UPLOAD_RETRY_DELAY)
+            continue
+        f.close()
+        return msg
 
 def run_transfer(req_id, dst_dir, dst_name, src_dir, src_name, tmp_name,
                             client_operand_index, **entity_params):
@@ -59,37 +280,24 @@ def run_transfer(req_id, dst_dir, dst_name, src_dir, src_name, tmp_name,
         tmp_name = tmp_name,
         **entity_params
     )
-    # connect to server
-    f = client_sock_file(conf['server'], WALT_SERVER_TCP_PORT)
-    # send the request id
-    Requests.send_id(f, req_id)
-    # wait for the READY message from the server
-    f.readline()
-    # write the parameters
-    write_pickle(params, f)
     # handle client-side archiving / unarchiving
     with ProgressMessageThread('Transfering...') as message_thread:
         if client_operand_index == 0:
             # client is sending
-            writer = SmartWriter(f)
-            with tarfile.open(mode='w|', fileobj=writer, dereference=True) as archive:
-                archive.add(os.path.join(src_dir, src_name), arcname=tmp_name)
-            # let the other end know we are done writing
-            writer.shutdown_write()
-            # wait the other end to close
-            writer.wait_remote_close()
-            # ok done
-            writer.close()
-            # did we detect a message sent to us during the transfer?
-            msg = writer.get_msg()
+            msg = upload(req_id, params, os.path.join(src_dir, src_name),
+                         tmp_name, message_thread)
+            # did we get a message from the receiving process?
             if len(msg) > 0:
                 # yes, interrupt the progress meter and print it
                 message_thread.interrupt(msg)
         else:
             # client is receiving
-            with tarfile.open(mode='r|', fileobj=f) as archive:
+            f = client_sock_file(conf['server'], WALT_SERVER_TCP_PORT)
+            start_transfer(f, req_id, params)
+            reader = ProgressReader(f, message_thread.set_progress)
+            with tarfile.open(mode='r|', fileobj=reader) as archive:
                 archive.extractall(path=dst_dir)
             tmp_path = os.path.join(dst_dir, tmp_name)
             dst_path = os.path.join(dst_dir, dst_name)
             os.rename(tmp_path, dst_path)
-    f.close()
+            f.close()
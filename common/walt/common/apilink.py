@@ -1,11 +1,13 @@
 #!/usr/bin/env python
-import os, sys
+import os, sys, struct
 from select import select
-from socket import socket, error as SocketError
+from socket import socket, AF_UNIX, error as SocketError
+from walt.common.codec import CODEC_VERSION, FRAME_HEADER, encode_frame, decode_payload
 from walt.common.constants import WALT_SERVER_DAEMON_PORT
+from walt.common.io import read_exactly, write_all
 from walt.common.reusable import reusable
 from walt.common.tools import BusyIndicator
-from walt.common.tcp import Requests
+from walt.common.tcp import Requests, get_peer_uid
 
 # exceptions may occur if the client disconnects.
 # we should ignore those.
@@ -26,6 +28,28 @@ class APIChannel(object):
     def fileno(self):
         return self.sock_file.fileno()
 
+# Same as APIChannel, but messages are encoded with the binary
+# codec of walt/common/codec.py instead of repr() / eval().
+# This is used when the API session is started with REQ_API_SESSION_BINARY.
+class BinaryAPIChannel(APIChannel):
+    def write(self, *args):
+        if self.sock_file.closed:
+            return
+        write_all(self.sock_file, encode_frame(args))
+    def read(self):
+        if self.sock_file.closed:
+            return None
+        try:
+            header = read_exactly(self.sock_file, FRAME_HEADER.size)
+            if header is None:
+                return None
+            payload = read_exactly(self.sock_file, FRAME_HEADER.unpack(header)[0])
+            if payload is None:
+                return None
+            return decode_payload(payload)
+        except (ValueError, struct.error, OSError, SocketError):
+            return None
+
 # The following pair of classes allows to pass API calls efficiently
 # over a network socket.
 #
@@ -94,14 +118,27 @@ class LinkException(Exception):
 
 DEFAULT_BUSY_LABEL = 'Server is working'
 
+# Result of a pipelined API call (cf. ServerAPIConnection.pipelined()).
+class APIFuture(object):
+    def __init__(self, conn):
+        self.conn = conn
+        self.done = False
+        self.value = None
+    def set_result(self, value):
+        self.value = value
+        self.done = True
+    def result(self):
+        if not self.done:
+            self.conn.wait_api_result(self)
+        return self.value
+
 @reusable
 class ServerAPIConnection(object):
-    def __init__(self, server_ip, local_service, target_api):
+    def __init__(self, server_ip, local_service, target_api, agent_socket = None):
         self.target_api = target_api
         self.server_ip = server_ip
-        self.sock = socket()
-        self.sock_file = self.sock.makefile('rwb',0)
-        self.api_channel = APIChannel(self.sock_file)
+        self.agent_socket = agent_socket
+        self.sock, self.sock_file, self.api_channel = None, None, None
         self.remote_version = None
         is_interactive = os.isatty(sys.stdout.fileno()) and \
                             os.isatty(sys.stdin.fileno())
@@ -112,13 +149,63 @@ class ServerAPIConnection(object):
         else:
             self.indicator = Fake()
         self.connected = False
+        self.next_req_id = 0
+        self.futures = {}   # req_id -> APIFuture
     # since the object is reusable we must ensure we connect only once.
     def connect(self):
         if not self.connected:
-            self.sock.connect((self.server_ip, WALT_SERVER_DAEMON_PORT))
-            self.sock_file.write(b'%d\n%s\n' % (Requests.REQ_API_SESSION, self.target_api.encode('UTF-8')))
-            self.remote_version = int(self.sock_file.readline().strip())
+            if self.connect_agent():
+                self.connected = True
+                return
+            try:
+                # try the binary codec first
+                self.start_session(Requests.REQ_API_SESSION_BINARY,
+                                   b'%d\n' % CODEC_VERSION)
+                self.api_channel = BinaryAPIChannel(self.sock_file)
+            except (ValueError, OSError):
+                # older servers close the connection
+                self.sock.close()
+                self.start_session(Requests.REQ_API_SESSION)
+                self.api_channel = APIChannel(self.sock_file)
             self.connected = True
+    # if a client agent is running, get a session from it
+    # (cf. walt/client/agent.py)
+    # the socket and the agent must belong to the user, otherwise another
+    # user could impersonate the agent.
+    def connect_agent(self):
+        if self.agent_socket is None:
+            return False
+        try:
+            if os.lstat(self.agent_socket).st_uid != os.getuid():
+                return False
+        except OSError:
+            return False    # no agent running
+        try:
+            self.start_session(Requests.REQ_API_SESSION_BINARY,
+                               b'%d\n' % CODEC_VERSION, self.agent_socket)
+            self.api_channel = BinaryAPIChannel(self.sock_file)
+            return True
+        except (ValueError, OSError):
+            # agent stopped or failing, connect to the server directly
+            self.sock.close()
+            return False
+    def start_session(self, req_id, extra_header = b'', unix_path = None):
+        if unix_path is None:
+            self.sock = socket()
+            address = (self.server_ip, WALT_SERVER_DAEMON_PORT)
+        else:
+            self.sock = socket(AF_UNIX)
+            address = unix_path
+        self.sock_file = self.sock.makefile('rwb',0)
+        self.sock.connect(address)
+        if unix_path is not None:
+            peer_uid = get_peer_uid(self.sock)
+            if peer_uid is not None and peer_uid != os.getuid():
+                raise ConnectionRefusedError('Agent socket owned by another user.')
+        self.sock_file.write(b'%d\n%s\n' % (req_id, self.target_api.encode('UTF-8')) + \
+                             extra_header)
+        # the server answers with its version
+        self.remote_version = int(self.sock_file.readline().strip())
     def set_busy_label(self, label):
         self.indicator.set_label(label)
     def set_default_busy_label(self):
@@ -137,10 +224,33 @@ class ServerAPIConnection(object):
         self.api_channel.write('API_CALL', path, args, kwargs)
         # wait for the result
         return self.wait_api_result()
+    # Pipelined mode: calls made through the returned proxy are sent
+    # immediately, tagged with a request id, and return an APIFuture.
+    # e.g.:
+    # f1 = server.pipelined().func1()
+    # f2 = server.pipelined().func2()
+    # res1, res2 = f1.result(), f2.result()
+    # The server may run func2 before func1 returns, thus only
+    # independent calls should be pipelined.
+    def pipelined(self):
+        return AttrCallAggregator(self.do_pipelined_api_call)
+    def do_pipelined_api_call(self, path, args, kwargs):
+        future = APIFuture(self)
+        if not isinstance(self.api_channel, BinaryAPIChannel):
+            # older servers: run the call right away
+            future.set_result(self.do_remote_api_call(path, args, kwargs))
+            return future
+        req_id = self.next_req_id
+        self.next_req_id += 1
+        self.futures[req_id] = future
+        self.api_channel.write('API_CALL_ID', req_id, path, args, kwargs)
+        return future
     def handle_api_call(self, path, args, kwargs):
         res = self.local_api_handler.do(path, args, kwargs)
         self.api_channel.write('RESULT', res)
-    def wait_api_result(self):
+    # wait for the result of the last non-pipelined call, or, if
+    # <future> is specified, for the result of this pipelined call.
+    def wait_api_result(self, future = None):
         self.indicator.start()
         api_result = None
         while True:
@@ -158,16 +268,28 @@ class ServerAPIConnection(object):
                 if event[0] == 'API_CALL':
                     self.handle_api_call(*event[1:])
                     continue
-                elif event[0] == 'EXCEPTION':
-                    sys.exit('Unexpected server-side issue! %s' % event[1])
+                elif event[0] in ('EXCEPTION', 'EXCEPTION_ID'):
+                    sys.exit('Unexpected server-side issue! %s' % event[-1])
                 elif event[0] == 'RESULT':
+                    if future is not None:
+                        # late result of a call interrupted by ctrl-C
+                        continue
                     api_result = event[1]
                     break
+                elif event[0] == 'RESULT_ID':
+                    # result of a pipelined call (maybe not the one we wait for)
+                    req_future = self.futures.pop(event[1], None)
+                    if req_future is not None:
+                        req_future.set_result(event[2])
+                    if future is not None and future.done:
+                        break
+                    continue
             raise LinkException('Unexpected communication issue with the server.')
         self.indicator.done()
         return api_result
     def __del__(self):
-        self.sock.close()
+        if self.sock is not None:
+            self.sock.close()
 
 class VoidAPIService(object):
     pass
@@ -175,13 +297,14 @@ class VoidAPIService(object):
 # This class provides a 'with' environment to connect to
 # the server API.
 class ServerAPILink(object):
-    def __init__(self, server_ip, target_api, local_service = None):
+    def __init__(self, server_ip, target_api, local_service = None, agent_socket = None):
         if local_service == None:
             local_service = VoidAPIService()
         self.conn = ServerAPIConnection(
             server_ip,
             local_service,
-            target_api)
+            target_api,
+            agent_socket)
     def __enter__(self):
         self.conn.connect()
         return self.conn.client_proxy
@@ -0,0 +1,65 @@
+import struct, zlib, lzma
+
+# Chunked transfer mode, used when uploading files with walt node cp
+# and walt image cp.
+#
+# The client first sends a fingerprint of the part of the tar stream
+# the server already received (cf. 'OFFSET' below):
+# - offset (8 bytes)
+# - crc32 of the tar stream up to this offset (4 bytes)
+# When resuming, the client generates the tar stream again: if it is
+# not the same (e.g. a file was modified), the fingerprint does not
+# match, and the transfer is restarted from offset 0.
+#
+# Then the client cuts the tar stream into chunks, and sends each one as:
+# <header> <payload>
+# with header fields:
+# - offset of the chunk in the tar stream (8 bytes)
+# - size of the chunk (4 bytes)
+# - size of the payload (4 bytes)
+# - crc32 of the chunk (4 bytes)
+# - compression of the payload (1 byte, index in COMPRESSIONS)
+# (big-endian).
+# The payload is the chunk, compressed independently of other chunks,
+# thus a transfer can be resumed at any chunk boundary, and the client
+# may change the compression at any chunk (e.g. depending on the
+# throughput of the link).
+# A chunk of size 0 ends the transfer.
+#
+# The server sends text lines:
+# - 'OFFSET <offset> <compressions>' when the connection starts: offset
+#   is 0 for a new transfer, or the offset where an interrupted transfer
+#   should resume; compressions is the comma-separated list of
+#   compressions accepted by the server.
+# - 'RESTART' when the fingerprint does not match: the server starts
+#   the transfer again from scratch, and closes the connection; the
+#   client should reconnect.
+# - 'ACK <offset>' when data up to this offset was written to the
+#   receiving process.
+# - 'END <length>' when the receiving process ended, followed by
+#   <length> bytes of output of this process (error messages).
+#   The client should stop sending chunks when it gets this message.
+
+CHUNK_HEADER = struct.Struct('!QIIIB')
+FINGERPRINT = struct.Struct('!QI')
+CHUNK_SIZE = 1024 * 1024
+COMPRESSIONS = ('none', 'zlib', 'lzma')
+
+def compress_chunk(compression, level, chunk):
+    if compression == 'zlib':
+        return zlib.compress(chunk, level)
+    elif compression == 'lzma':
+        return lzma.compress(chunk, preset = level)
+    return chunk
+
+# decompress at most <size> bytes
+# (we should not trust the payload to fit in memory)
+def decompress_chunk(compression, payload, size):
+    if compression == 'zlib':
+        return zlib.decompressobj().decompress(payload, size)
+    elif compression == 'lzma':
+        return lzma.LZMADecompressor().decompress(payload, max_length = size)
+    return payload
+
+def check_chunk(chunk, size, crc):
+    return len(chunk) == size and zlib.crc32(chunk) == crc
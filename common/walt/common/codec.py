@@ -0,0 +1,150 @@
+import struct
+from datetime import datetime, timedelta, timezone
+
+# Binary encoding of API messages (cf. BinaryAPIChannel in apilink.py).
+#
+# Each message is sent as a frame: the length of the payload (4 bytes)
+# followed by the payload, which is an encoded value.
+# A value is encoded as a type code (1 byte) followed by type-specific
+# data:
+# - 'N', 'T', 'F': None, True, False (no data)
+# - 'i': int, as a signed 64-bit integer
+# - 'I': larger int, as a string of decimal digits
+# - 'f': float, as a 64-bit float
+# - 's', 'b': str (encoded in UTF-8) or bytes, as <len> <data>
+# - 't', 'l', 'e': tuple, list or set, as <count> <item> <item> ...
+# - 'd': dict, as <count> <key> <value> <key> <value> ...
+# - 'D': naive datetime, as <year> <month> <day> <hour> <minute>
+#        <second> <microsecond>
+# - 'Z': datetime with a timezone: same as 'D', followed by the UTC
+#        offset, in seconds.
+# Lengths and counts are unsigned 32-bit integers, all integers are
+# big-endian.
+# Tuple subclasses (e.g. named tuples) are sent as tuples, and dict
+# subclasses as dicts.
+#
+# CODEC_VERSION must be incremented when this format changes.
+
+CODEC_VERSION = 1
+FRAME_HEADER = struct.Struct('!I')
+LENGTH = struct.Struct('!I')
+INT = struct.Struct('!q')
+FLOAT = struct.Struct('!d')
+DATETIME = struct.Struct('!HBBBBBI')
+UTC_OFFSET = struct.Struct('!i')
+INT_MIN, INT_MAX = -2**63, 2**63-1
+
+SEQUENCE_CODES = ((tuple, b't'), (list, b'l'), (set, b'e'), (frozenset, b'e'))
+SEQUENCE_TYPES = { b't': tuple, b'l': list, b'e': set }
+
+def encode_value(buf, value):
+    if value is None:
+        buf += b'N'
+    elif value is True:
+        buf += b'T'
+    elif value is False:
+        buf += b'F'
+    elif isinstance(value, int):
+        if INT_MIN <= value <= INT_MAX:
+            buf += b'i'
+            buf += INT.pack(value)
+        else:
+            encode_data(buf, b'I', str(value).encode('ascii'))
+    elif isinstance(value, float):
+        buf += b'f'
+        buf += FLOAT.pack(value)
+    elif isinstance(value, str):
+        encode_data(buf, b's', value.encode('UTF-8'))
+    elif isinstance(value, (bytes, bytearray)):
+        encode_data(buf, b'b', value)
+    elif isinstance(value, dict):
+        buf += b'd'
+        buf += LENGTH.pack(len(value))
+        for k, v in value.items():
+            encode_value(buf, k)
+            encode_value(buf, v)
+    elif isinstance(value, datetime):
+        offset = value.utcoffset()
+        buf += b'D' if offset is None else b'Z'
+        buf += DATETIME.pack(value.year, value.month, value.day, value.hour,
+                             value.minute, value.second, value.microsecond)
+        if offset is not None:
+            buf += UTC_OFFSET.pack(int(offset.total_seconds()))
+    else:
+        for cls, code in SEQUENCE_CODES:
+            if isinstance(value, cls):
+                buf += code
+                buf += LENGTH.pack(len(value))
+                for item in value:
+                    encode_value(buf, item)
+                return
+        raise TypeError('Cannot encode value of type %s.' % type(value).__name__)
+
+def encode_data(buf, code, data):
+    buf += code
+    buf += LENGTH.pack(len(data))
+    buf += data
+
+# returns (value, offset of next value)
+def decode_value(payload, offset):
+    code = payload[offset:offset+1]
+    offset += 1
+    if code == b'N':
+        return None, offset
+    elif code == b'T':
+        return True, offset
+    elif code == b'F':
+        return False, offset
+    elif code == b'i':
+        return INT.unpack_from(payload, offset)[0], offset + INT.size
+    elif code == b'f':
+        return FLOAT.unpack_from(payload, offset)[0], offset + FLOAT.size
+    elif code in (b's', b'b', b'I'):
+        length = LENGTH.unpack_from(payload, offset)[0]
+        offset += LENGTH.size
+        data = bytes(payload[offset:offset+length])
+        if len(data) != length:
+            raise ValueError('Truncated message.')
+        offset += length
+        if code == b's':
+            return data.decode('UTF-8'), offset
+        elif code == b'I':
+            return int(data.decode('ascii')), offset
+        return data, offset
+    elif code in SEQUENCE_TYPES:
+        count = LENGTH.unpack_from(payload, offset)[0]
+        offset += LENGTH.size
+        items = []
+        for i in range(count):
+            item, offset = decode_value(payload, offset)
+            items.append(item)
+        return SEQUENCE_TYPES[code](items), offset
+    elif code == b'd':
+        count = LENGTH.unpack_from(payload, offset)[0]
+        offset += LENGTH.size
+        d = {}
+        for i in range(count):
+            k, offset = decode_value(payload, offset)
+            d[k], offset = decode_value(payload, offset)
+        return d, offset
+    elif code in (b'D', b'Z'):
+        value = datetime(*DATETIME.unpack_from(payload, offset))
+        offset += DATETIME.size
+        if code == b'Z':
+            utc_offset = UTC_OFFSET.unpack_from(payload, offset)[0]
+            offset += UTC_OFFSET.size
+            value = value.replace(tzinfo = timezone(timedelta(seconds = utc_offset)))
+        return value, offset
+    raise ValueError('Unknown type code %r.' % code)
+
+def encode_frame(value):
+    buf = bytearray(FRAME_HEADER.size)
+    encode_value(buf, value)
+    FRAME_HEADER.pack_into(buf, 0, len(buf) - FRAME_HEADER.size)
+    return buf
+
+def decode_payload(payload):
+    value, offset = decode_value(payload, 0)
+    if offset != len(payload):
+        raise ValueError('Unexpected data at end of message.')
+    return value
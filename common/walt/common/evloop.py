@@ -1,8 +1,9 @@
 #!/usr/bin/env python
-import os, sys
-from select import poll, select, POLLIN, POLLPRI
+import os, sys, select as select_module
+from select import poll, select, POLLIN, POLLPRI, POLLOUT
 from time import time
 from heapq import heappush, heappop
+from bisect import bisect_left
 
 POLL_OPS_READ = POLLIN | POLLPRI
 
@@ -11,49 +12,264 @@ def is_read_event_ok(ev):
     # (i.e. POLLIN or POLLPRI)
     return (ev & (POLL_OPS_READ) > 0)
 
+def is_write_event_ok(ev):
+    # check that we can write (i.e. POLLOUT)
+    return (ev & POLLOUT > 0)
+
+# Backends: they wrap the OS polling mechanism.
+# Event masks are the same for poll and epoll (on linux, EPOLLIN == POLLIN,
+# etc.), thus listeners and EventLoop do not depend on the backend.
+
+class PollBackend(object):
+    supports_edge_triggered = False
+    def __init__(self):
+        self.poller = poll()
+    def register(self, fd, events, edge_triggered = False):
+        self.poller.register(fd, events)
+    def modify(self, fd, events, edge_triggered = False):
+        self.poller.modify(fd, events)
+    def unregister(self, fd):
+        self.poller.unregister(fd)
+    # timeout is in seconds, None means infinite
+    def poll(self, timeout):
+        if timeout is not None:
+            timeout = timeout * 1000
+        return self.poller.poll(timeout)
+
+class EpollBackend(object):
+    supports_edge_triggered = True
+    def __init__(self):
+        self.poller = select_module.epoll()
+    def register(self, fd, events, edge_triggered = False):
+        if edge_triggered:
+            events |= select_module.EPOLLET
+        self.poller.register(fd, events)
+    def modify(self, fd, events, edge_triggered = False):
+        if edge_triggered:
+            events |= select_module.EPOLLET
+        self.poller.modify(fd, events)
+    def unregister(self, fd):
+        try:
+            self.poller.unregister(fd)
+        except OSError:
+            # the kernel already removed this fd from the epoll set
+            # when it was closed
+            pass
+    def poll(self, timeout):
+        if timeout is None:
+            timeout = -1
+        return self.poller.poll(timeout)
+
+# epoll is the default backend on linux. Caution: when a file descriptor
+# is closed, epoll just drops it from its set, without notifying the
+# listener (poll() reports POLLNVAL instead). Thus listeners must always
+# be removed by calling remove_listener() (which closes them), and not
+# closed directly.
+BACKENDS = dict(poll = PollBackend)
+if hasattr(select_module, 'epoll'):     # linux only
+    BACKENDS.update(epoll = EpollBackend)
+    DEFAULT_BACKEND = 'epoll'
+else:
+    DEFAULT_BACKEND = 'poll'
+
+# Optional instrumentation of the event loop (cf. EventLoop.enable_stats()).
+# Durations are in seconds. Histograms are exported as dicts with
+# a list of (upper_bound, count) buckets; the upper bound of the last
+# bucket is None (unbounded).
+DURATION_BOUNDS = (0.0001, 0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1, 5)
+COUNT_BOUNDS = (1, 2, 4, 8, 16, 32, 64, 128, 256)
+
+class Histogram(object):
+    def __init__(self, bounds):
+        self.bounds = bounds
+        self.buckets = [0] * (len(bounds) + 1)
+        self.count = 0
+        self.total = 0
+        self.max = 0
+
+    def add(self, value):
+        self.buckets[bisect_left(self.bounds, value)] += 1
+        self.count += 1
+        self.total += value
+        self.max = max(self.max, value)
+
+    def to_dict(self):
+        return dict(count = self.count,
+                    total = self.total,
+                    max = self.max,
+                    buckets = list(zip(self.bounds + (None,), self.buckets)))
+
+class EventLoopStats(object):
+    def __init__(self, slow_threshold):
+        self.slow_threshold = slow_threshold
+        self.handlers = {}      # listener class name -> histogram
+        self.planned_handlers = {}  # target class name -> histogram
+        self.lateness = Histogram(DURATION_BOUNDS)
+        self.poll_wait = Histogram(DURATION_BOUNDS)
+        self.ready_fds = Histogram(COUNT_BOUNDS)
+        self.slow_events = 0
+
+    def record_handler(self, histograms, handler, duration):
+        name = handler.__class__.__name__
+        if name not in histograms:
+            histograms[name] = Histogram(DURATION_BOUNDS)
+        histograms[name].add(duration)
+        if duration > self.slow_threshold:
+            self.slow_events += 1
+            print('warning: slow event handler (%.3fs): %r' % (duration, handler))
+
+    def record_listener_event(self, listener, duration):
+        self.record_handler(self.handlers, listener, duration)
+
+    def record_planned_event(self, target, lateness, duration):
+        self.lateness.add(lateness)
+        self.record_handler(self.planned_handlers, target, duration)
+
+    def record_poll(self, wait, num_ready_fds):
+        self.poll_wait.add(wait)
+        self.ready_fds.add(num_ready_fds)
+
+    def to_dict(self):
+        return dict(
+            handlers = { name: h.to_dict() for name, h in self.handlers.items() },
+            planned_handlers = { name: h.to_dict() \
+                                    for name, h in self.planned_handlers.items() },
+            planned_event_lateness = self.lateness.to_dict(),
+            poll_wait = self.poll_wait.to_dict(),
+            ready_fds = self.ready_fds.to_dict(),
+            slow_events = self.slow_events,
+            slow_threshold = self.slow_threshold)
+
+# A planned event, as returned by EventLoop.plan_event().
+# Calling cancel() prevents the event (and its repetitions) from
+# being processed.
+class PlannedEvent(object):
+    def __init__(self, ts, target, repeat_delay, kwargs):
+        self.ts = ts
+        self.target = target
+        self.repeat_delay = repeat_delay
+        self.kwargs = kwargs
+        self.cancelled = False
+
+    def cancel(self):
+        self.cancelled = True
+
 # EventLoop allows to monitor incoming data on a set of
 # file descriptors, and call the appropriate listener when 
 # input data is detected.
 # Any number of listeners may be added, by calling 
 # register_listener().
+# A listener may also ask to be notified when its file descriptor
+# is writable, by calling update_listener() with POLLOUT in the
+# events mask. In this case, its method handle_write_event() will
+# be called.
+# A listener may also provide a method is_valid(); if it returns
+# False (and no data is pending), the listener is removed. Only the
+# listeners providing this method are checked.
+# A listener whose handle_event() method reads its file descriptor
+# until no more data is pending may set an attribute 'edge_triggered = True':
+# with the epoll backend, it will then only be notified when new data
+# arrives (with the poll backend, this attribute is ignored).
 # In case of error, the file descriptor is removed from 
 # the set of watched descriptors.
 # When the set is empty, the loop stops.
+# Calling enable_stats() turns on instrumentation: durations of event
+# handlers, poll() wait times, planned events lateness, number of ready
+# fds per poll() call, and warnings about slow handlers (cf. get_stats()).
+# Planned events are grouped by deadline: self.planned_events maps
+# a deadline to the list of events planned at this time (processed in
+# the order they were planned), and the heap self.deadlines only holds
+# distinct deadlines. Thus planning an event at an already known
+# deadline (e.g. next second boundary) is O(1), and cancelling an
+# event is O(1) too (it is just marked as cancelled).
 
 class EventLoop(object):
-    def __init__(self):
-        self.listeners = {}
-        self.planned_events = []
-        self.poller = poll()
+    def __init__(self, backend = DEFAULT_BACKEND):
+        self.listeners = {}         # fd -> listener
+        self.listener_fds = {}      # id(listener) -> fd
+        self.validated_fds = set()  # fds of listeners providing is_valid()
+        self.edge_triggered_fds = set()
+        self.planned_events = {}    # deadline -> [ planned event, ... ]
+        self.deadlines = []         # heap
+        self.poller = BACKENDS[backend]()
+        self.stats = None
+
+    def enable_stats(self, slow_threshold = 0.1):
+        self.stats = EventLoopStats(slow_threshold)
 
+    # returns None if stats are not enabled
+    def get_stats(self):
+        if self.stats is None:
+            return None
+        return self.stats.to_dict()
+
+    # returns a PlannedEvent object, which allows to cancel the event
     def plan_event(self, ts, target, repeat_delay = None, **kwargs):
-        heappush(self.planned_events,
-                 (ts, target, repeat_delay, kwargs))
+        event = PlannedEvent(ts, target, repeat_delay, kwargs)
+        self.add_planned_event(event)
+        return event
+
+    def add_planned_event(self, event):
+        events = self.planned_events.get(event.ts)
+        if events is None:
+            events = []
+            self.planned_events[event.ts] = events
+            heappush(self.deadlines, event.ts)
+        events.append(event)
 
+    def process_planned_events(self):
+        now = time()
+        while len(self.deadlines) > 0 and self.deadlines[0] <= now:
+            ts = heappop(self.deadlines)
+            for event in self.planned_events.pop(ts):
+                if event.cancelled:
+                    continue
+                if self.stats is None:
+                    event.target.handle_planned_event(**event.kwargs)
+                else:
+                    t0 = time()
+                    event.target.handle_planned_event(**event.kwargs)
+                    self.stats.record_planned_event(
+                                event.target, t0 - ts, time() - t0)
+                if event.repeat_delay and not event.cancelled:
+                    event.ts = ts + event.repeat_delay
+                    if event.ts < now:                          # we are very late
+                        event.ts = now + event.repeat_delay     # reschedule
+                    self.add_planned_event(event)
+
+    # timeout in seconds (None means no timeout)
     def get_timeout(self):
-        if len(self.planned_events) == 0:
+        if len(self.deadlines) == 0:
             return None
         else:
-            return (self.planned_events[0][0] - time())*1000
+            return max(0, self.deadlines[0] - time())
 
     def update_listener(self, listener, events=POLL_OPS_READ):
         fd = listener.fileno()
-        self.poller.unregister(fd)
-        self.poller.register(fd, events)
+        self.poller.modify(fd, events, fd in self.edge_triggered_fds)
 
     def register_listener(self, listener, events=POLL_OPS_READ):
         fd = listener.fileno()
         self.listeners[fd] = listener
-        self.poller.register(fd, events)
+        self.listener_fds[id(listener)] = fd
+        if hasattr(listener, 'is_valid'):
+            self.validated_fds.add(fd)
+        edge_triggered = self.poller.supports_edge_triggered and \
+                            getattr(listener, 'edge_triggered', False) == True
+        if edge_triggered:
+            self.edge_triggered_fds.add(fd)
+        self.poller.register(fd, events, edge_triggered)
         #print 'new listener:', listener
 
+    # removing a listener which was already removed has no effect
+    # (thus listener.close() may remove related listeners).
     def remove_listener(self, in_listener):
         #print 'removing ' + str(in_listener)
         #sys.stdout.flush()
-        # find fd
-        for fd, listener in self.listeners.items():
-            if listener is in_listener:
-                break
+        listener = in_listener
+        fd = self.listener_fds.pop(id(listener), None)
+        if fd is None:
+            return
         # do no fail in case of issue in listener.close()
         # because anyway we do not need this listener anymore
         try:
@@ -61,57 +277,68 @@ class EventLoop(object):
         except Exception as e:
             print('warning: got exception in listener.close():', e)
         del self.listeners[fd]
+        self.validated_fds.discard(fd)
+        self.edge_triggered_fds.discard(fd)
         self.poller.unregister(fd)
 
     def loop(self):
         while True:
             # handle any expired planned event
-            now = time()
-            while len(self.planned_events) > 0 and \
-                        self.planned_events[0][0] <= now:
-                ts, target, repeat_delay, kwargs = \
-                                    heappop(self.planned_events)
-                target.handle_planned_event(**kwargs)
-                if repeat_delay:
-                    next_ts = ts + repeat_delay
-                    if next_ts < now:                   # we are very late
-                        next_ts = now + repeat_delay    # reschedule
-                    self.plan_event(
-                        next_ts, target, repeat_delay, **kwargs)
+            self.process_planned_events()
             # if a listener provides a method is_valid(),
             # check it and remove it if result is False
-            for listener in list(self.listeners.values()):
-                try:
-                    if listener.is_valid() == False:
-                        # some data may have been buffered, we check this.
-                        # (if this is the case, then we will delay the
-                        # removal of this listener)
-                        r, w, x = select([listener], [], [], 0)
-                        if len(r) == 0:     # ok, no data
-                            self.remove_listener(listener)
-                except AttributeError:
-                    pass # this listener does not implement is_valid()
+            for fd in list(self.validated_fds):
+                listener = self.listeners[fd]
+                if listener.is_valid() == False:
+                    # some data may have been buffered, we check this.
+                    # (if this is the case, then we will delay the
+                    # removal of this listener)
+                    r, w, x = select([listener], [], [], 0)
+                    if len(r) == 0:     # ok, no data
+                        self.remove_listener(listener)
             # stop the loop if no more listeners
             if len(self.listeners) == 0:
                 break
             # wait for an event
+            poll_ts = time()
             res = self.poller.poll(self.get_timeout())
             # save the time of the event as soon as possible
             ts = time()
-            if len(res) == 0:
-                continue    # poll() was stopped because of the timeout
-            # process the event
-            fd, ev = res[0]
-            listener = self.listeners[fd]
-            # if error, we will remove the listener below
-            should_close = not is_read_event_ok(ev)
-            if not should_close:
-                # no error, let the listener
+            if self.stats is not None:
+                self.stats.record_poll(ts - poll_ts, len(res))
+            # process all events returned by poll()
+            # (poll() returns an empty list in case of timeout)
+            events = [ (fd, ev, self.listeners.get(fd)) for fd, ev in res ]
+            for fd, ev, listener in events:
+                # a previous handler may have removed this listener
+                # (and maybe registered another one with the same fd)
+                if listener is None or self.listeners.get(fd) is not listener:
+                    continue
+                if self.stats is None:
+                    self.handle_listener_event(listener, ev, ts)
+                else:
+                    t0 = time()
+                    self.handle_listener_event(listener, ev, ts)
+                    self.stats.record_listener_event(listener, time() - t0)
+
+    def handle_listener_event(self, listener, ev, ts):
+        should_close = False
+        if is_write_event_ok(ev):
+            # the listener asked to be notified
+            # when its fd is writable
+            res = listener.handle_write_event(ts)
+            should_close = (res == False)
+        if not should_close:
+            if is_read_event_ok(ev):
+                # let the listener
                 # handle the event
                 res = listener.handle_event(ts)
                 # if False was returned, we will
                 # close this listener.
                 should_close = (res == False)
-            if should_close:
-                self.remove_listener(listener)
+            elif not is_write_event_ok(ev):
+                # error, we will remove the listener below
+                should_close = True
+        if should_close:
+            self.remove_listener(listener)
 
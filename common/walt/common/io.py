@@ -1,5 +1,5 @@
 #!/usr/bin/env python
-import os, sys, socket
+import os, sys, socket, errno, stat, ctypes, ctypes.util
 from select import select
 
 # This function allows to disable buffering
@@ -21,32 +21,31 @@ def unbuffered(f, mode):
     return os.fdopen(os.dup(f.fileno()), mode, 0)
 
 # SmartFile objects provide an additional read_available() method
-# allowing to read all chars pending without blocking.
+# allowing to read all chars pending (up to BUFFER_SIZE) without blocking.
+# file_r must be unbuffered, since we read on its file descriptor.
 class SmartFile(object):
-    BUFFER_SIZE = 1024 * 10
+    BUFFER_SIZE = 1024 * 64
     def __init__(self, file_r, file_w = None):
         self.file_r = file_r
         self.file_w = file_w
-        # timeout=0, do not block
-        self.select_args = [[file_r],[],[file_r],0]
-        self.chars = [ b'' ] * SmartFile.BUFFER_SIZE
+        # reusable read buffer
+        self.buf = bytearray(SmartFile.BUFFER_SIZE)
+        self.buf_view = memoryview(self.buf)
     def read_available(self):
-        # continue reading until there
-        # is nothing more to read or we reach BUFFER_SIZE
-        chars = self.chars
+        # we cannot set O_NONBLOCK on the file descriptor: it is usually
+        # shared with file_w (socket, pty), which relies on blocking writes.
+        # thus we check input is pending (select with timeout=0) and
+        # then read it all at once.
+        # returns b'' if nothing is pending or on end of input.
         try:
-            for i in range(SmartFile.BUFFER_SIZE):
-                rlist, wlist, elist = select(*self.select_args)
-                # error or no input (timeout), leave the loop
-                if len(elist) > 0 or len(rlist) == 0:
-                    i -= 1
-                    break
-                chars[i] = self.file_r.read(1)
-                if chars[i] == b'':
-                    break   # empty read
-        except:
-            chars[i] = b''
-        return b''.join(chars[:i+1])
+            fd = self.file_r.fileno()
+            rlist, wlist, elist = select((fd,), (), (fd,), 0)
+            if len(elist) > 0 or len(rlist) == 0:
+                return b''
+            size = os.readv(fd, (self.buf,))
+        except Exception:
+            return b''
+        return bytes(self.buf_view[:size])
     def __getattr__(self, attr):
         if attr in ('write', 'flush'):
             f = self.file_w
@@ -66,6 +65,25 @@ class SmartFile(object):
     def __del__(self):
         self.close()
 
+# read <size> bytes on a raw (unbuffered) stream
+def read_exactly(stream, size):
+    buf = bytearray()
+    while len(buf) < size:
+        chunk = stream.read(size - len(buf))
+        if not chunk:
+            return None     # end of stream
+        buf += chunk
+    return bytes(buf)
+
+# write all of <data> on a raw (unbuffered) stream
+def write_all(stream, data):
+    data = memoryview(data)
+    while len(data) > 0:
+        written = stream.write(data)
+        if written is None:     # non-raw stream, all data was written
+            break
+        data = data[written:]
+
 # Copy what's available from a SmartFile
 # to an output stream
 def read_and_copy(in_reader, out):
@@ -78,3 +96,140 @@ def read_and_copy(in_reader, out):
     except socket.error:
         return False    # close
 
+# splice(2) wrapper. os.splice() is only available with python >= 3.10,
+# thus we call the libc function through ctypes otherwise.
+# (splice is None if not available on this platform.)
+SPLICE_F_MOVE, SPLICE_F_NONBLOCK = 1, 2
+
+def get_libc_splice():
+    try:
+        libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno = True)
+        libc_splice = libc.splice
+    except (OSError, AttributeError):
+        return None
+    libc_splice.argtypes = (ctypes.c_int, ctypes.c_void_p, ctypes.c_int,
+                            ctypes.c_void_p, ctypes.c_size_t, ctypes.c_uint)
+    libc_splice.restype = ctypes.c_ssize_t
+    def splice(fd_in, fd_out, count, flags = 0):
+        size = libc_splice(fd_in, None, fd_out, None, count, flags)
+        if size == -1:
+            err = ctypes.get_errno()
+            raise OSError(err, os.strerror(err))
+        return size
+    return splice
+
+if hasattr(os, 'splice'):
+    splice = os.splice
+else:
+    splice = get_libc_splice()
+
+# StreamRelay objects copy what's available from a file (or socket)
+# to another one, for event loop listeners forwarding a stream
+# (e.g. walt node expose).
+# On linux, data is moved with splice() through a pipe, without going
+# through python buffers. If splice() is not supported for these files
+# (e.g. a tty), we fallback to os.read() and os.write(). The output is
+# checked when the relay is created (splice() to a tty fails on some
+# kernels), and the input when the first data is relayed.
+class StreamRelay(object):
+    CHUNK_SIZE = 1024 * 64
+    def __init__(self, file_in, file_out):
+        self.file_in = file_in
+        self.file_out = file_out
+        self.fd_in = file_in.fileno()
+        self.fd_out = file_out.fileno()
+        self.pipe = None
+        self.buf = None
+        if splice is not None and \
+                not stat.S_ISCHR(os.fstat(self.fd_out).st_mode):
+            try:
+                self.pipe = os.pipe()
+            except OSError:
+                pass
+    # copy what is available on input.
+    # returns False on end of input (or error).
+    def relay(self):
+        try:
+            if self.pipe is not None:
+                res = self.splice()
+                if res is not None:
+                    return res
+            return self.copy()
+        except BlockingIOError:
+            return True     # nothing available
+        except OSError:
+            return False
+    # relay all data pending on input, for edge-triggered listeners
+    # (cf. EventLoop). returns False on end of input (or error).
+    def relay_all(self):
+        while True:
+            if self.relay() == False:
+                return False
+            try:
+                rlist, wlist, elist = select((self.fd_in,), (), (), 0)
+            except (OSError, ValueError):
+                return False
+            if len(rlist) == 0:
+                return True     # nothing more pending
+    def splice(self):
+        pipe_r, pipe_w = self.pipe
+        try:
+            size = splice(self.fd_in, pipe_w, StreamRelay.CHUNK_SIZE,
+                          SPLICE_F_MOVE | SPLICE_F_NONBLOCK)
+        except OSError as e:
+            if e.errno != errno.EINVAL:
+                raise
+            # splice() not supported with these files
+            self.close_pipe()
+            return None
+        if size == 0:
+            return False    # end of input
+        while size > 0:
+            try:
+                size -= splice(pipe_r, self.fd_out, size, SPLICE_F_MOVE)
+            except OSError as e:
+                if e.errno not in (errno.EINVAL, errno.EAGAIN):
+                    raise
+                # splice() not supported with this output, or output is
+                # non-blocking: write what remains in the pipe, and use
+                # copy() from now on.
+                self.drain_pipe(size)
+                self.close_pipe()
+                break
+        return True
+    def drain_pipe(self, size):
+        pipe_r, pipe_w = self.pipe
+        while size > 0:
+            data = os.read(pipe_r, size)
+            size -= len(data)
+            self.write_output(data)
+    def write_output(self, data):
+        data = memoryview(data)
+        while len(data) > 0:
+            try:
+                data = data[os.write(self.fd_out, data):]
+            except BlockingIOError:
+                # non-blocking output, wait until it is writable
+                select((), (self.fd_out,), ())
+    def copy(self):
+        if self.buf is None:
+            self.buf = bytearray(StreamRelay.CHUNK_SIZE)
+        size = os.readv(self.fd_in, (self.buf,))
+        if size == 0:
+            return False    # end of input
+        self.write_output(memoryview(self.buf)[:size])
+        return True
+    # forward the end of input to the other end, if output is a socket.
+    # (the other direction of the connection may still be in use.)
+    def shutdown_output(self):
+        try:
+            self.file_out.shutdown(socket.SHUT_WR)
+        except (OSError, AttributeError):
+            pass
+    def close_pipe(self):
+        if self.pipe is not None:
+            for fd in self.pipe:
+                os.close(fd)
+            self.pipe = None
+    def close(self):
+        self.close_pipe()
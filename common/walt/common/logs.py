@@ -0,0 +1,122 @@
+import struct
+from collections import deque
+from datetime import datetime, timedelta
+from walt.common.io import read_exactly
+from walt.common.tcp import read_pickle
+
+# Compact framing of the log records sent by the server to a
+# 'walt log show' client (cf. REQ_DUMP_LOGS, with framing='compact').
+#
+# After reading the request parameters, the server sends
+# COMPACT_FRAMING_MAGIC, then a sequence of frames.
+# Each frame is made of the length of its payload (4 bytes) followed
+# by the payload, which is a sequence of entries:
+# - 'S' <stream_id> <sender_len> <stream_len> <sender> <stream>
+#   associates names to a stream id (sent once per stream).
+# - 'R' <stream_id> <timestamp> <line_len> <line>
+#   is a log record.
+# Integers are big-endian, timestamps are signed 64-bit integer
+# numbers of microseconds since 1970-01-01 (server local time, as stored
+# in the db), other integers are unsigned, and strings are encoded in
+# UTF-8.
+#
+# Servers which do not know compact framing ignore the 'framing'
+# parameter and send one pickled dict per record (cf. get_logs_reader()).
+
+COMPACT_FRAMING_MAGIC = b'WLC1'
+FRAME_HEADER = struct.Struct('!I')
+STREAM_ENTRY = struct.Struct('!cIHH')
+RECORD_ENTRY = struct.Struct('!cIqI')
+EPOCH = datetime(1970, 1, 1)
+MICROSECOND = timedelta(microseconds = 1)
+
+def encode_stream_entry(stream_id, sender, stream):
+    sender, stream = sender.encode('UTF-8'), stream.encode('UTF-8')
+    return STREAM_ENTRY.pack(b'S', stream_id, len(sender), len(stream)) + \
+                sender + stream
+
+def encode_record_entry(stream_id, timestamp, line):
+    line = line.encode('UTF-8')
+    timestamp = (timestamp - EPOCH) // MICROSECOND
+    return RECORD_ENTRY.pack(b'R', stream_id, timestamp, len(line)) + line
+
+def encode_frame(payload):
+    return FRAME_HEADER.pack(len(payload)) + bytes(payload)
+
+class CompactLogsReader(object):
+    def __init__(self, stream):
+        self.stream = stream
+        self.streams = {}
+        self.records = deque()
+    def read_frame(self):
+        header = read_exactly(self.stream, FRAME_HEADER.size)
+        if header is None:
+            return False
+        payload = read_exactly(self.stream, FRAME_HEADER.unpack(header)[0])
+        if payload is None:
+            return False
+        offset = 0
+        while offset < len(payload):
+            if payload[offset:offset+1] == b'S':
+                entry_type, stream_id, sender_len, stream_len = \
+                        STREAM_ENTRY.unpack_from(payload, offset)
+                offset += STREAM_ENTRY.size
+                sender = payload[offset:offset+sender_len].decode('UTF-8')
+                offset += sender_len
+                stream = payload[offset:offset+stream_len].decode('UTF-8')
+                offset += stream_len
+                self.streams[stream_id] = dict(sender = sender, stream = stream)
+            else:
+                entry_type, stream_id, timestamp, line_len = \
+                        RECORD_ENTRY.unpack_from(payload, offset)
+                offset += RECORD_ENTRY.size
+                line = payload[offset:offset+line_len].decode('UTF-8')
+                offset += line_len
+                record = dict(
+                        timestamp = EPOCH + timestamp * MICROSECOND,
+                        line = line)
+                record.update(self.streams[stream_id])
+                self.records.append(record)
+        return True
+    # return the next record (as a dict), or None at the end of the stream
+    def read_record(self):
+        while len(self.records) == 0:
+            if not self.read_frame():
+                return None
+        return self.records.popleft()
+
+# Reader of one pickled dict per record.
+# prefix holds the first bytes of the stream, already read by
+# get_logs_reader().
+class PickleLogsReader(object):
+    def __init__(self, stream, prefix):
+        self.stream = stream
+        self.prefix = prefix
+    # read() and readline() are used by pickle.load()
+    def read(self, size):
+        data, self.prefix = self.prefix[:size], self.prefix[size:]
+        if len(data) < size:
+            rest = read_exactly(self.stream, size - len(data))
+            if rest is not None:
+                data += rest
+        return data
+    def readline(self):
+        pos = self.prefix.find(b'\n')
+        if pos >= 0:
+            data, self.prefix = self.prefix[:pos+1], self.prefix[pos+1:]
+            return data
+        data, self.prefix = self.prefix, b''
+        return data + self.stream.readline()
+    # return the next record (as a dict), or None at the end of the stream
+    def read_record(self):
+        return read_pickle(self)
+
+# read the beginning of the server answer, and return the appropriate
+# reader, or None if the connection was closed.
+def get_logs_reader(stream):
+    header = read_exactly(stream, len(COMPACT_FRAMING_MAGIC))
+    if header is None:
+        return None
+    if header == COMPACT_FRAMING_MAGIC:
+        return CompactLogsReader(stream)
+    return PickleLogsReader(stream, header)
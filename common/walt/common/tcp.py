@@ -1,4 +1,4 @@
-import socket, pickle
+import socket, pickle, struct
 from walt.common.tools import set_close_on_exec
 from walt.common.io import SmartFile
 
@@ -16,6 +16,7 @@ class Requests(object):
     REQ_API_SESSION = 10
     REQ_TCP_TO_NODE = 11
     REQ_FAKE_TFTP_GET = 12
+    REQ_API_SESSION_BINARY = 13
 
     # the request id message may be specified directly as
     # as a decimal string (e.g. '4') or by the corresponding
@@ -50,6 +51,16 @@ def write_pickle(obj, stream):
     pickle.dump(obj, stream, pickle.HIGHEST_PROTOCOL)
     stream.flush()
 
+# uid of the process at the other end of a unix socket
+# (linux only: returns None if SO_PEERCRED is not available)
+PEER_CREDENTIALS = struct.Struct('3i')     # pid, uid, gid
+def get_peer_uid(sock):
+    if not hasattr(socket, 'SO_PEERCRED'):
+        return None
+    creds = sock.getsockopt(socket.SOL_SOCKET, socket.SO_PEERCRED,
+                            PEER_CREDENTIALS.size)
+    return PEER_CREDENTIALS.unpack(creds)[1]
+
 class SmartSocketFile(SmartFile):
     def __init__(self, sock):
         self.sock = sock
@@ -1,4 +1,5 @@
-import sys, signal, itertools
+import os, sys, signal, itertools
+from collections import deque
 from multiprocessing import Pipe
 from threading import Thread, current_thread
 from select import select
@@ -72,28 +73,101 @@ class EvThreadsManager(object):
                 except:
                     pass
 
-WAIT_MAX = 0.1
+# maximum number of messages processed by one call to handle_event(),
+# in order to let the event loop process other listeners too.
+MAX_EVENTS_PER_CALL = 64
+
+# File descriptor used to wake up a thread waiting in its event loop:
+# an eventfd if available (python >= 3.10), a self-pipe otherwise.
+class WakeupFd(object):
+    def __init__(self):
+        if hasattr(os, 'eventfd'):
+            self.fd_r = self.fd_w = os.eventfd(0, os.EFD_NONBLOCK | os.EFD_CLOEXEC)
+        else:
+            self.fd_r, self.fd_w = os.pipe()
+            os.set_blocking(self.fd_r, False)
+            os.set_blocking(self.fd_w, False)
+    def fileno(self):
+        return self.fd_r
+    def notify(self):
+        try:
+            if self.fd_w == self.fd_r:
+                os.eventfd_write(self.fd_w, 1)
+            else:
+                os.write(self.fd_w, b'\x00')
+        except BlockingIOError:
+            pass    # pipe or counter is full, wakeup is already pending
+    def clear(self):
+        try:
+            while len(os.read(self.fd_r, 4096)) > 0:
+                pass
+        except BlockingIOError:
+            pass    # nothing more to read
+    def wait(self, timeout):
+        select((self.fd_r,), (), (), timeout)
+    def close(self):
+        os.close(self.fd_r)
+        if self.fd_w != self.fd_r:
+            os.close(self.fd_w)
+
+# Messages between threads of the same process are passed by reference
+# in deques (appending and popping are thread-safe), and the
+# receiving thread is woken up through a WakeupFd.
+# There is one deque per priority level (0 is the highest).
+class ThreadQueue(object):
+    def __init__(self, num_priorities = 1):
+        self.queues = tuple(deque() for i in range(num_priorities))
+        self.wakeup = WakeupFd()
+        self.closed = False
+    def put(self, obj, priority = 0):
+        self.queues[priority].append(obj)
+        self.wakeup.notify()
+    def get(self):
+        for queue in self.queues:
+            if len(queue) > 0:
+                return queue.popleft()
+    def __len__(self):
+        return sum(len(queue) for queue in self.queues)
+    def close(self):
+        self.closed = True
+        self.wakeup.notify()
 
 class ThreadConnector:
+    num_priorities = 1
     def connect(self, remote):
-        self.pipe, remote.pipe = Pipe()
+        self.inbox = ThreadQueue(self.num_priorities)
+        remote.inbox = ThreadQueue(remote.num_priorities)
+        self.outbox, remote.outbox = remote.inbox, self.inbox
     def close(self):
-        self.pipe.close()
+        # let the remote end know
+        self.outbox.close()
     def fileno(self):
-        return self.pipe.fileno()
-    def write(self, obj):
-        self.pipe.send(obj)
+        return self.inbox.wakeup.fileno()
+    def write(self, obj, priority = 0):
+        self.outbox.put(obj, priority)
     def read(self):
-        return self.pipe.recv()
+        return self.inbox.get()
     def poll(self):
-        return self.pipe.poll()
+        return len(self.inbox) > 0
+    # returns True if the remote end was closed
+    def remote_closed(self):
+        return self.inbox.closed
+    # must be called before reading pending messages, otherwise
+    # a message written concurrently may be left unnoticed.
+    def clear_wakeup(self):
+        self.inbox.wakeup.clear()
+    # let the event loop call us again, even if no new message arrives
+    def reschedule(self):
+        self.inbox.wakeup.notify()
     def wait_next_event(self):
-        # we implement a loop in order to make this wait
-        # interruptible (every WAIT_MAX seconds)
-        while not self.pipe.poll(WAIT_MAX):
-            pass
+        while not self.poll() and not self.remote_closed():
+            self.inbox.wakeup.wait(None)
+            if not self.poll():
+                # spurious wakeup (messages already processed)
+                self.clear_wakeup()
 
 PRIORITIES = { 'RESULT':0, 'EXCEPTION':1, 'API_CALL':2 }
+NUM_PRIORITIES = len(PRIORITIES)
 
 class RPCSession(object):
     def __init__(self, connector, remote_req_id, local_service):
@@ -127,6 +201,7 @@ class RPCContext(object):
         self.task = RPCTask(connector, remote_req_id)
 
 class RPCThreadConnector(ThreadConnector):
+    num_priorities = NUM_PRIORITIES
     def __init__(self, default_service = None):
         self.submitted_tasks = {}
         self.ids_generator = itertools.count()
@@ -141,27 +216,34 @@ class RPCThreadConnector(ThreadConnector):
         return RPCSession(self, remote_req_id, local_service)
     def handle_event(self, ts):
         return self.handle_next_event()
+    def write(self, event):
+        ThreadConnector.write(self, event, PRIORITIES[event[0]])
     def handle_next_event(self):
-        events = []
-        while self.poll():
-            events.append(self.read())
-        if len(events) == 0:
-            return False    # no data, quit
-        events.sort(key=lambda x: PRIORITIES[x[0]])
-        for event in events:
-            if event[0] == 'API_CALL':
-                self.handle_api_call(*event[1:])
-                continue
-            elif event[0] == 'RESULT':
-                local_req_id, result = event[1], event[2]
-                sync = self.submitted_tasks[local_req_id].sync
-                cb = self.submitted_tasks[local_req_id].result_cb
-                if cb != None:
-                    cb(result)
-                if sync:
-                    self.results[local_req_id] = result
-                del self.submitted_tasks[local_req_id]
-                continue
+        self.clear_wakeup()
+        if not self.poll():
+            if self.remote_closed():
+                return False    # no more data, quit
+            return              # spurious wakeup
+        # messages are read in priority order (cf. ThreadQueue)
+        for i in range(MAX_EVENTS_PER_CALL):
+            if not self.poll():
+                return
+            self.handle_rpc_event(self.read())
+        if self.poll():
+            self.reschedule()   # we will process the rest later
+    def handle_rpc_event(self, event):
+        if event[0] == 'API_CALL':
+            self.handle_api_call(*event[1:])
+        elif event[0] == 'RESULT':
+            local_req_id, result = event[1], event[2]
+            sync = self.submitted_tasks[local_req_id].sync
+            cb = self.submitted_tasks[local_req_id].result_cb
+            if cb != None:
+                cb(result)
+            if sync:
+                self.results[local_req_id] = result
+            del self.submitted_tasks[local_req_id]
+        else:
             raise Exception('Broken communication with remote end.')
     def handle_api_call(self, local_req_id, remote_req_id, path, args, kwargs, sync):
         if local_req_id == -1:
@@ -4,3 +4,10 @@ SERVER_CONF='/etc/walt/server.conf'
 
 def get_conf():
     return read_json(SERVER_CONF)
+
+# optional settings are grouped by section in the conf file, e.g.
+# "logs": { "retention-days": 30 }
+def get_conf_option(conf, section, option, default = None):
+    if conf is None:
+        return default
+    return conf.get(section, {}).get(option, default)
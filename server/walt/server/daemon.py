@@ -12,12 +12,13 @@ def run():
     tman = EvThreadsManager()
     # create main thread
     main_thread = ServerMainThread(tman)
-    # create blocking thread
-    blocking_thread = ServerBlockingThread(tman, main_thread.server)
+    # create blocking threads (one per worker of the blocking tasks manager)
+    for index, worker in enumerate(main_thread.blocking.workers):
+        blocking_thread = ServerBlockingThread(tman, main_thread.server, index)
+        worker.connect(blocking_thread.main)
     # create hub thread
     hub_thread = ServerHubThread(tman)
-    # connect them
-    main_thread.blocking.connect(blocking_thread.main)
+    # connect it
     main_thread.hub.connect(hub_thread.main)
     # start!
     tman.start()
@@ -3,7 +3,7 @@
 from walt.server.const import WALT_DBNAME, WALT_DBUSER
 from walt.server.tools import columnate
 import psycopg2, shlex, uuid
-from psycopg2.extras import NamedTupleCursor
+from psycopg2.extras import NamedTupleCursor, execute_values
 from subprocess import Popen, PIPE
 from sys import stderr
 
@@ -20,6 +20,8 @@ class PostgresDB():
         # allow name-based access to columns
         self.c = self.conn.cursor(cursor_factory = NamedTupleCursor)
         self.server_cursors = {}
+        self.column_names = {}
+        self.prepared_statements = {}
 
     def __del__(self):
         self.conn.commit()
@@ -46,31 +48,59 @@ class PostgresDB():
         return self.c
 
     # with server cursors, the resultset is not sent all at once to the client.
-    def create_server_cursor(self):
+    # itersize is the number of rows fetched at each network roundtrip.
+    def create_server_cursor(self, named_tuples = True, withhold = True,
+                             itersize = None):
         name = str(uuid.uuid4())
-        # we share a database connection, thus we have to create a cursor
+        if named_tuples:
+            cursor_factory = NamedTupleCursor
+        else:
+            cursor_factory = None   # plain tuples
+        # if we share a database connection, we have to create a cursor
         # WITH HOLD, otherwise any other thread issuing a commit would
         # cause the cursor to be discarded.
-        self.server_cursors[name] = self.conn.cursor(
-                                        name = name,
-                                        cursor_factory = NamedTupleCursor,
-                                        withhold = True)
+        cursor = self.conn.cursor(  name = name,
+                                    cursor_factory = cursor_factory,
+                                    withhold = withhold)
+        if itersize is not None:
+            cursor.itersize = itersize
+        self.server_cursors[name] = cursor
         return name
 
     def delete_server_cursor(self, name):
         self.server_cursors[name].close()
         del self.server_cursors[name]
 
+    # column names are cached, call this when the schema changes.
+    def invalidate_schema_cache(self):
+        self.column_names = {}
+        if len(self.prepared_statements) > 0:
+            self.c.execute("DEALLOCATE ALL;")
+            self.prepared_statements = {}
+
+    # retrieve the column names of all tables at once.
+    def load_column_names(self):
+        self.invalidate_schema_cache()
+        self.c.execute("""  SELECT table_name, column_name
+                            FROM information_schema.columns
+                            WHERE table_schema = 'public'
+                            ORDER BY table_name, ordinal_position;""")
+        for table, column in self.c.fetchall():
+            self.column_names[table] = self.column_names.get(table, ()) + (column,)
+
     def get_column_names(self, table):
-        self.c.execute("SELECT * FROM %s LIMIT 0" % table)
-        return tuple(col_desc[0] for col_desc in self.c.description)
+        if table not in self.column_names:
+            self.c.execute("SELECT * FROM %s LIMIT 0" % table)
+            self.column_names[table] = tuple(
+                    col_desc[0] for col_desc in self.c.description)
+        return self.column_names[table]
 
     # from a dictionary of the form <col_name> -> <value>
     # we want to filter-out keys that are not column names,
     # and return ([<col_name>, ...], [<value>, ...]).
     def get_cols_and_values(self, table, dictionary):
         # retrieve fields names for this table 
-        col_names = set(self.get_column_names(table))
+        col_names = self.get_column_names(table)
         res = {}
         for k in dictionary:
             # filter-out keys of dictionary that are not 
@@ -87,6 +117,28 @@ class PostgresDB():
         return (list(t[0] for t in items),
                 list(t[1] for t in items))
 
+    # queries issued by insert(), delete(), update() and select*()
+    # are run as server-side prepared statements, in order to avoid
+    # parsing and planning them again and again.
+    # <key> identifies the statement, and <sql> is its text, with
+    # placeholders $1, $2, etc. (cf. get_placeholders()).
+    def execute_prepared(self, key, sql, values):
+        name = self.prepared_statements.get(key)
+        if name is None:
+            name = 'walt_stmt_%d' % len(self.prepared_statements)
+            self.c.execute("PREPARE %s AS %s;" % (name, sql))
+            self.prepared_statements[key] = name
+        if len(values) == 0:
+            self.c.execute("EXECUTE %s;" % name)
+        else:
+            self.c.execute("EXECUTE %s (%s);" % (
+                            name, ','.join(['%s'] * len(values))), values)
+        return self.c
+
+    # return placeholders $1, $2, ... $<num> for a prepared statement
+    def get_placeholders(self, num):
+        return [ '$%d' % i for i in range(1, num + 1) ]
+
     # format a where clause with ANDs on the specified constraints
     def get_where_clause_from_constraints(self, constraints):
         if len(constraints) > 0:
@@ -96,7 +148,8 @@ class PostgresDB():
 
     # format a where clause with ANDs on the specified columns
     def get_where_clause_pattern(self, cols):
-        constraints = [ "%s=%%s" % col for col in cols ]
+        constraints = [ "%s=%s" % (col, placeholder) for col, placeholder in \
+                            zip(cols, self.get_placeholders(len(cols))) ]
         return self.get_where_clause_from_constraints(constraints)
 
     # allow statements like:
@@ -108,20 +161,54 @@ class PostgresDB():
                 VALUES (%s)""" % (
                     table,
                     ','.join(cols),
-                    ','.join(['%s'] * len(values)))
+                    ','.join(self.get_placeholders(len(values))))
         if returning:
             sql += " RETURNING %s" % returning
-        self.c.execute(sql + ';', tuple(values))
+        self.execute_prepared(('insert', table, tuple(cols), returning), sql, values)
         if returning:
             return self.c.fetchone()[0]
 
+    # run func(*args, **kwargs) in a savepoint: if it fails, only the
+    # changes it made are rolled back, not the whole current transaction.
+    def run_in_savepoint(self, func, *args, **kwargs):
+        self.c.execute("SAVEPOINT walt_savepoint;")
+        try:
+            res = func(*args, **kwargs)
+        except psycopg2.Error:
+            self.c.execute("ROLLBACK TO SAVEPOINT walt_savepoint;")
+            raise
+        self.c.execute("RELEASE SAVEPOINT walt_savepoint;")
+        return res
+
+    # allow inserting many rows with a single query:
+    # db.insert_multiple("logs", ("stream_id", "line"), [(1, "a"), (1, "b")])
+    # if this query fails (e.g. one of the rows is invalid), rows are
+    # inserted one by one, thus only invalid rows are lost.
+    # returns the list of rows which could not be inserted.
+    def insert_multiple(self, table, col_names, rows):
+        sql = "INSERT INTO %s(%s) VALUES %%s;" % (table, ','.join(col_names))
+        try:
+            self.run_in_savepoint(execute_values, self.c, sql, rows,
+                                  page_size=len(rows))
+            return []
+        except psycopg2.Error:
+            if len(rows) == 1:
+                return list(rows)
+        failed = []
+        for row in rows:
+            try:
+                self.run_in_savepoint(execute_values, self.c, sql, (row,))
+            except psycopg2.Error:
+                failed.append(row)
+        return failed
+
     # allow statements like:
     # db.delete("topology", switch_mac=swmac, switch_port=swport)
     def delete(self, table, **kwargs):
         cols, values = self.get_cols_and_values(table, kwargs)
         where_clause = self.get_where_clause_pattern(cols)
-        sql = "DELETE FROM %s %s;" % (table, where_clause)
-        self.c.execute(sql, values)
+        sql = "DELETE FROM %s %s" % (table, where_clause)
+        self.execute_prepared(('delete', table, tuple(cols)), sql, values)
         return self.c.rowcount  # number of rows deleted
 
     # allow statements like:
@@ -129,22 +216,24 @@ class PostgresDB():
     def update(self, table, primary_key_name, **kwargs):
         cols, values = self.get_cols_and_values(table, kwargs)
         values.append(kwargs[primary_key_name])
-        self.c.execute("""
+        placeholders = self.get_placeholders(len(values))
+        sql = """
                 UPDATE %s 
                 SET %s
-                WHERE %s = %%s;""" % (
+                WHERE %s = %s""" % (
                     table,
-                    ','.join("%s = %%s" % col for col in cols),
-                    primary_key_name),
-                    values)
+                    ','.join("%s = %s" % item for item in zip(cols, placeholders)),
+                    primary_key_name,
+                    placeholders[-1])
+        self.execute_prepared(('update', table, tuple(cols), primary_key_name),
+                              sql, values)
         return self.c.rowcount  # number of rows updated
 
     def select_no_fetch(self, table, **kwargs):
         cols, values = self.get_cols_and_values(table, kwargs)
         where_clause = self.get_where_clause_pattern(cols)
-        sql = "SELECT * FROM %s %s;" % (table, where_clause)
-        self.c.execute(sql, values)
-        return self.c
+        sql = "SELECT * FROM %s %s" % (table, where_clause)
+        return self.execute_prepared(('select', table, tuple(cols)), sql, values)
 
     # allow statements like:
     # mem_db.select("network", ip=ip)
@@ -0,0 +1,30 @@
+#!/usr/bin/env python
+from walt.server import conf
+from walt.server.conf import get_conf_option
+from walt.server.threads.main.db import LogsQueriesDB
+
+# Number of log records fetched at each roundtrip with the db when
+# streaming the logs history. It may be set in the "logs" section of
+# the server conf.
+LOGS_HISTORY_ITERSIZE = get_conf_option(conf, 'logs', 'history-itersize', 2000)
+LOGS_HISTORY_PROJECTIONS = 'l.stream_id, l.timestamp, l.line'
+
+# The blocking thread has its own db connection, thus its long queries
+# (e.g. a large logs history dump) do not serialize with the ones
+# of the main thread.
+class BlockingDB(LogsQueriesDB):
+
+    # iterate over the logs history, as plain tuples
+    # (stream_id, timestamp, line).
+    def get_logs(self, cursor_name, **kwargs):
+        sql, args = self.format_logs_query(LOGS_HISTORY_PROJECTIONS,
+                                ordering='l.timestamp', **kwargs)
+        cursor = self.server_cursors[cursor_name]
+        cursor.execute(sql, args)
+        return cursor
+
+    def create_logs_cursor(self):
+        # this connection is not shared, no need for a cursor WITH HOLD.
+        return self.create_server_cursor(named_tuples = False,
+                                         withhold = False,
+                                         itersize = LOGS_HISTORY_ITERSIZE)
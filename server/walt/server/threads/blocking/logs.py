@@ -1,20 +1,41 @@
+from walt.server.threads.main.logs import LOGS_BUFFER_FULL
 
+# number of records sent to the logs handler at once
+HISTORY_BATCH_SIZE = 512
+
+# db is the connection of the blocking thread (cf. BlockingDB)
 def stream_db_logs(db, logs_handler, **params):
-    # ensure all past logs are commited
-    db.commit()
     # let the logs handler start buffering realtime logs
+    # (past logs are commited in the main thread at this time)
     logs_handler.notify_history_processing_startup()
-    db.commit()
+    # event set by the logs handler when its outgoing buffer is drained
+    # (logs_handler is a proxy, but the event is passed by reference)
+    buffer_drained = logs_handler.get_buffer_drained_event()
     # create a server cursor
-    cursor_name = db.create_server_cursor()
+    cursor_name = db.create_logs_cursor()
     # start streaming db logs
+    batch = []
     for record in db.get_logs(cursor_name, **params):
-        d = record._asdict()
-        if logs_handler.write_to_client(
-                    senders_filtered = True, **d) == False:
-            break
+        batch.append(record)
+        if len(batch) == HISTORY_BATCH_SIZE:
+            if write_batch(logs_handler, buffer_drained, batch) == False:
+                break
+            batch = []
+    else:
+        write_batch(logs_handler, buffer_drained, batch)
     # delete server cursor
     db.delete_server_cursor(cursor_name)
+    db.commit()     # end the transaction
     # notify history dump is complete
     logs_handler.notify_history_processed()
 
+def write_batch(logs_handler, buffer_drained, batch):
+    if len(batch) == 0:
+        return
+    res = logs_handler.write_history_to_client(batch)
+    # if the outgoing buffer of the client is full,
+    # wait for it to be drained
+    if res == LOGS_BUFFER_FULL:
+        buffer_drained.wait()
+        res = None
+    return res
@@ -4,10 +4,12 @@ from walt.server.threads.blocking.images.publish import publish
 from walt.server.threads.blocking.images.metadata import update_hub_metadata
 from walt.server.threads.blocking.images.search import search
 from walt.server.threads.blocking.logs import stream_db_logs
+from walt.server.threads.blocking.db import BlockingDB
 
 class BlockingTasksService(object):
     def __init__(self, server):
         self.server = server
+        self.db = None
 
     def clone_image(self, context, *args, **kwargs):
         res = clone(context.requester.sync, self.server, *args, **kwargs)
@@ -26,7 +28,7 @@ class BlockingTasksService(object):
         context.task.return_result(res)
 
     def stream_db_logs(self, context, **params):
-        res = stream_db_logs(self.server.db, context.requester.sync, **params)
+        res = stream_db_logs(self.db, context.requester.sync, **params)
         context.task.return_result(res)
 
     def pull_image(self, context, image_fullname):
@@ -34,11 +36,13 @@ class BlockingTasksService(object):
         context.task.return_result(res)
 
 class ServerBlockingThread(EvThread):
-    def __init__(self, tman, server):
-        EvThread.__init__(self, tman, 'server-blocking')
-        service = BlockingTasksService(server)
-        self.main = RPCThreadConnector(service)
+    def __init__(self, tman, server, index):
+        EvThread.__init__(self, tman, 'server-blocking-%d' % index)
+        self.service = BlockingTasksService(server)
+        self.main = RPCThreadConnector(self.service)
 
     def prepare(self):
+        # open our own db connection
+        self.service.db = BlockingDB()
         self.register_listener(self.main)
 
@@ -1,6 +1,24 @@
+from time import time
 from walt.common.version import __version__
 from walt.common.tcp import Requests
-from walt.common.apilink import APIChannel, AttrCallAggregator
+from walt.common.apilink import APIChannel, BinaryAPIChannel, AttrCallAggregator
+from walt.common.codec import CODEC_VERSION
+
+# Output written by the server on the client stdout or stderr is not
+# sent immediately: it is buffered, and sent at the next iteration of
+# the event loop, or before any other message to the client (thus
+# ordering is preserved). We do not wait for the client to acknowledge
+# these calls: the results it sends back are just discarded
+# (cf. pending_results).
+BUFFERED_REQUESTER_CALLS = ('stdout.write', 'stderr.write',
+                            'stdout.flush', 'stderr.flush')
+
+# Pipelined calls (cf. ServerAPIConnection.pipelined() on client side)
+# are sent as ('API_CALL_ID', <req_id>, <func>, <args>, <kwargs>), and
+# their result as ('RESULT_ID', <req_id>, <res>) or
+# ('EXCEPTION_ID', <req_id>, <msg>). The client does not wait for
+# the result of a pipelined call before sending the next one.
+CLIENT_CALLS = ('API_CALL', 'API_CALL_ID')
 
 class APISessionManager(object):
     REQ_ID = Requests.REQ_API_SESSION
@@ -15,9 +33,12 @@ class APISessionManager(object):
         self.session_id = None
         self.requester = AttrCallAggregator(self.forward_requester_request)
         self.rpc_session = self.main.local_service(self.requester)
-    def record_task(self, attr, args, kwargs):
+        self.output = []            # buffered (path, args) requester calls
+        self.output_flush_planned = False
+        self.pending_results = 0    # results of unacknowledged calls
+    def record_task(self, attr, args, kwargs, req_id = None):
         self.rpc_session.async.run_task(self.session_id, attr, args, kwargs).then(
-            self.return_result
+            lambda res: self.return_result(res, req_id)
         )
     def fileno(self):
         return self.api_channel.fileno()
@@ -30,46 +51,115 @@ class APISessionManager(object):
         event = self.api_channel.read()
         if event == None:
             return False
+        if self.is_discarded_result(event):
+            return True
+        return self.record_call(event)
+    def record_call(self, event):
         # e.g. if you send ('CLOSE',) instead of ('API_CALL','<func>',<args>,<kwargs>)
         # the connection will be closed from server side.
-        if len(event) != 4:
+        if event[0] == 'API_CALL_ID' and len(event) == 5:
+            req_id, attr, args, kwargs = event[1:]
+        elif event[0] == 'API_CALL' and len(event) == 4:
+            req_id = None
+            attr, args, kwargs = event[1:]
+        else:
             return False
-        attr, args, kwargs = event[1:]
         print('hub api_call:', self.target_api, attr, args, kwargs)
-        self.record_task(attr, args, kwargs)
+        self.record_task(attr, args, kwargs, req_id)
         return True
-    def return_result(self, res):
+    def return_result(self, res, req_id = None):
         # client might already be disconnected (ctrl-C),
         # thus we ignore errors.
         try:
+            self.flush_output()
             if isinstance(res, BaseException):
-                self.api_channel.write('EXCEPTION', str(res))
+                if req_id is None:
+                    self.api_channel.write('EXCEPTION', str(res))
+                else:
+                    self.api_channel.write('EXCEPTION_ID', req_id, str(res))
             else:
-                self.api_channel.write('RESULT', res)
+                if req_id is None:
+                    self.api_channel.write('RESULT', res)
+                else:
+                    self.api_channel.write('RESULT_ID', req_id, res)
         except:
             pass
     def init_session(self):
         try:
             self.target_api = self.sock_file.readline().decode('UTF-8').strip()
+            if not self.init_codec():
+                return False
             self.session_id = self.rpc_session.sync.create_session(
                                 self.target_api, self.remote_ip)
             self.sock_file.write(b"%d\n" % int(__version__))
             return True
         except:
             return False
+    # nothing to do with the line / repr() / eval() codec
+    def init_codec(self):
+        return True
     def close(self):
         if self.session_id != None:
             self.rpc_session.sync.destroy_session(self.session_id)
         self.sock_file.close()
     def forward_requester_request(self, path, args, kwargs):
         args = args[1:] # discard 1st arg, rpc context
+        if path in BUFFERED_REQUESTER_CALLS:
+            self.buffer_output(path, args)
+            return None
         try:
+            self.flush_output()
             self.api_channel.write('API_CALL', path, args, kwargs)
-            res = self.api_channel.read()
-            if res == None:
-                return None
-            return res[1]
-        except REQUESTER_API_IGNORED:
+            while True:
+                res = self.api_channel.read()
+                if res == None:
+                    return None
+                if self.is_discarded_result(res):
+                    continue
+                if res[0] in CLIENT_CALLS:
+                    # pipelined call sent before the client got our request
+                    self.record_call(res)
+                    continue
+                return res[1]
+        except self.REQUESTER_API_IGNORED:
             pass
         return None
+    def is_discarded_result(self, event):
+        if event[0] == 'RESULT' and self.pending_results > 0:
+            self.pending_results -= 1
+            return True
+        return False
+    def buffer_output(self, path, args):
+        if len(self.output) > 0 and path.endswith('.write') and \
+                self.output[-1][0] == path:
+            # concatenate with previous write on the same stream
+            self.output[-1] = (path, (self.output[-1][1][0] + args[0],))
+        else:
+            self.output.append((path, args))
+        if not self.output_flush_planned:
+            self.thread.plan_event(ts = time(), target = self)
+            self.output_flush_planned = True
+    def handle_planned_event(self):
+        self.output_flush_planned = False
+        try:
+            self.flush_output()
+        except:
+            pass    # client disconnected
+    def flush_output(self):
+        output, self.output = self.output, []
+        for path, args in output:
+            self.api_channel.write('API_CALL', path, args, {})
+            self.pending_results += 1
 
+# API session using the binary codec of walt/common/codec.py.
+# Compared to REQ_API_SESSION, the client sends an additional line
+# with the codec version after the target API.
+class BinaryAPISessionManager(APISessionManager):
+    REQ_ID = Requests.REQ_API_SESSION_BINARY
+    def init_codec(self):
+        codec_version = int(self.sock_file.readline().strip())
+        if codec_version != CODEC_VERSION:
+            # the client will fallback to REQ_API_SESSION
+            return False
+        self.api_channel = BinaryAPIChannel(self.sock_file)
+        return True
@@ -1,10 +1,10 @@
 from walt.common.thread import EvThread
 from walt.common.tcp import TCPServer
 from walt.common.thread import RPCThreadConnector
-from walt.server.threads.hub.client import APISessionManager
+from walt.server.threads.hub.client import APISessionManager, BinaryAPISessionManager
 from walt.common.constants import WALT_SERVER_DAEMON_PORT
 
-TCP_LISTENER_CLASSES = ( APISessionManager, )
+TCP_LISTENER_CLASSES = ( APISessionManager, BinaryAPISessionManager )
 
 class ServerHubThread(EvThread):
     def __init__(self, tman):
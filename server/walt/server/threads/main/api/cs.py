@@ -120,6 +120,10 @@ class CSAPI(APISession):
     def count_logs(self, context, **kwargs):
         return context.server.count_logs(**kwargs)
 
+    @api_expose_method
+    def get_evloop_stats(self, context):
+        return context.server.get_evloop_stats()
+
     @api_expose_method
     def forget(self, context, device_name):
         context.server.forget_device(device_name)
@@ -68,3 +68,9 @@ class APISession(object):
             if hasattr(obj, 'cleanup'):
                 obj.cleanup()
 
+
+    # the client agent (cf. walt/client/agent.py) calls this before
+    # reusing this session for another walt command.
+    def reset_session(self, context):
+        self.cleanup()
+        self.session_objects = []
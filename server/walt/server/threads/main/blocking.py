@@ -1,7 +1,51 @@
+from collections import deque, OrderedDict
 from walt.common.thread import RPCThreadConnector
 from walt.common.apilink import AttrCallRunner, AttrCallAggregator
+from walt.common.tools import SimpleContainer
+from walt.server import conf
+from walt.server.conf import get_conf_option
 
-class BlockingTasksManager(RPCThreadConnector):
+# Blocking tasks are dispatched on a pool of blocking threads.
+# Long tasks (docker hub transfers) share non thread-safe objects
+# (server.docker, the image store, etc.), thus they are serialized:
+# they run on one blocking thread at a time, and short tasks (image
+# search, logs history dump) are dispatched on the other threads, thus
+# they are not delayed by a large image clone.
+# The number of threads may be set in the "blocking" section of the
+# server conf.
+BLOCKING_WORKERS = max(2, get_conf_option(conf, 'blocking', 'workers', 4))
+BLOCKING_LONG_TASK_WORKERS = 1
+
+SHORT_TASK, LONG_TASK = 0, 1
+
+# Tasks of a given kind are queued per requester key (the username for
+# client requests, None for requests of the server itself), and these
+# queues are served in a round-robin fashion.
+# (e.g. many nodes booting with a new image will not prevent a user
+# from cloning an image, and a user running many commands will not
+# delay other users.)
+class FairQueue(object):
+    def __init__(self):
+        self.queues = OrderedDict()     # requester key -> deque of tasks
+
+    def __len__(self):
+        return len(self.queues)
+
+    def put(self, key, task):
+        if key not in self.queues:
+            self.queues[key] = deque()
+        self.queues[key].append(task)
+
+    def get(self):
+        key, tasks = next(iter(self.queues.items()))
+        task = tasks.popleft()
+        # move this requester at the end
+        del self.queues[key]
+        if len(tasks) > 0:
+            self.queues[key] = tasks
+        return task
+
+class BlockingWorkerConnector(RPCThreadConnector):
     def session(self, requester):
         # we will receive:
         # service.<func>(rpc_context, <args...>)
@@ -15,23 +59,78 @@ class BlockingTasksManager(RPCThreadConnector):
         service = AttrCallAggregator(forward_to_requester)
         return self.local_service(service)
 
+class BlockingTasksManager(object):
+    def __init__(self):
+        self.workers = [ BlockingWorkerConnector() for i in range(BLOCKING_WORKERS) ]
+        self.idle_workers = list(self.workers)
+        self.queues = { SHORT_TASK: FairQueue(), LONG_TASK: FairQueue() }
+        self.running_long_tasks = 0
+
+    def join_event_loop(self, ev_loop):
+        for worker in self.workers:
+            ev_loop.register_listener(worker)
+
+    def submit(self, kind, key, requester, result_cb, method, *args, **kwargs):
+        task = SimpleContainer(kind = kind, requester = requester,
+                    result_cb = result_cb, method = method,
+                    args = args, kwargs = kwargs)
+        self.queues[kind].put(key, task)
+        self.dispatch()
+
+    def next_task(self):
+        if len(self.queues[SHORT_TASK]) > 0:
+            return self.queues[SHORT_TASK].get()
+        if len(self.queues[LONG_TASK]) > 0 and \
+                self.running_long_tasks < BLOCKING_LONG_TASK_WORKERS:
+            self.running_long_tasks += 1
+            return self.queues[LONG_TASK].get()
+        return None
+
+    def dispatch(self):
+        while len(self.idle_workers) > 0:
+            task = self.next_task()
+            if task is None:
+                break
+            self.run_task(self.idle_workers.pop(), task)
+
+    def run_task(self, worker, task):
+        if task.requester is None:
+            session = worker
+        else:
+            session = worker.session(task.requester)
+        getattr(session.async, task.method)(*task.args, **task.kwargs).then(
+                lambda res: self.task_done(worker, task, res))
+
+    def task_done(self, worker, task, res):
+        if task.kind == LONG_TASK:
+            self.running_long_tasks -= 1
+        self.idle_workers.append(worker)
+        if task.result_cb is not None:
+            task.result_cb(res)
+        self.dispatch()
+
     def clone_image(self, requester, result_cb, *args, **kwargs):
-        self.session(requester).async.clone_image(*args, **kwargs).then(result_cb)
+        self.submit(LONG_TASK, requester.get_username(), requester, result_cb,
+                    'clone_image', *args, **kwargs)
 
     def search_image(self, requester, result_cb, *args, **kwargs):
-        self.session(requester).async.search_image(*args, **kwargs).then(result_cb)
+        self.submit(SHORT_TASK, requester.get_username(), requester, result_cb,
+                    'search_image', *args, **kwargs)
 
     def publish_image(self, requester, result_cb, *args, **kwargs):
-        self.session(requester).async.publish_image(*args, **kwargs).then(result_cb)
+        self.submit(LONG_TASK, requester.get_username(), requester, result_cb,
+                    'publish_image', *args, **kwargs)
 
     def update_hub_metadata(self, requester, result_cb, *args, **kwargs):
-        self.session(requester).async.update_hub_metadata(*args, **kwargs).then(result_cb)
+        self.submit(LONG_TASK, requester.get_username(), requester, result_cb,
+                    'update_hub_metadata', *args, **kwargs)
 
     def pull_image(self, image_fullname, result_cb):
-        self.async.pull_image(image_fullname).then(result_cb)
+        self.submit(LONG_TASK, None, None, result_cb, 'pull_image', image_fullname)
 
     def stream_db_logs(self, logs_handler):
-        # request the blocking task to stream db logs
-        self.session(logs_handler).async.stream_db_logs(
-                            **logs_handler.params)
-
+        # request a blocking thread to stream db logs
+        # (the username is not known on logs connections, thus each
+        # logs client has its own queue)
+        self.submit(SHORT_TASK, logs_handler, logs_handler, None,
+                    'stream_db_logs', **logs_handler.params)
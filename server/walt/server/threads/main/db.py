@@ -1,15 +1,122 @@
 #!/usr/bin/env python
+import re, psycopg2
+try:
+    from re import _parser as sre_parse     # python >= 3.11
+except ImportError:
+    import sre_parse
+from walt.server import conf
+from walt.server.conf import get_conf_option
 from walt.server.postgres import PostgresDB
+from datetime import datetime, timedelta
 from time import time
 
 EV_AUTO_COMMIT              = 0
 EV_AUTO_COMMIT_PERIOD       = 2
+EV_LOGS_MAINTENANCE         = 1
+EV_LOGS_MAINTENANCE_PERIOD  = 3600
 
-class ServerDB(PostgresDB):
+# The logs table is partitioned by range of timestamps.
+# Each partition covers LOGS_PARTITION_DAYS days (e.g. 1 for daily
+# partitions, 7 for weekly partitions) and partitions are created
+# LOGS_PARTITIONS_AHEAD periods in advance.
+# Log lines not covered by these partitions (e.g. timestamps sent by
+# a node with a wrong clock) go to the default partition.
+# If LOGS_RETENTION_DAYS is set, older partitions are dropped.
+# These values may be set in the "logs" section of the server conf.
+LOGS_PARTITION_DAYS         = get_conf_option(conf, 'logs', 'partition-days', 1)
+LOGS_RETENTION_DAYS         = get_conf_option(conf, 'logs', 'retention-days', None)
+LOGS_PARTITIONS_AHEAD       = 2
+LOGS_LEGACY_PARTITION       = 'logs_legacy'
+LOGS_DEFAULT_PARTITION      = 'logs_default'
+LOGS_PARTITION_PATTERN      = 'logs_%Y%m%d'
+LOGS_BOUND_FORMAT           = '%Y-%m-%d %H:%M:%S'
+LOGS_BOUND_REGEXP           = re.compile(r"TO \('([^']*)'\)")
+
+# If "sql-prefilter" is enabled in the "logs" section of the server conf,
+# a trigram index is created on logs.line, and history queries are
+# prefiltered in SQL using literal parts of the regular expressions
+# (cf. get_like_patterns()). Exact matching is still done in python.
+LOGS_SQL_PREFILTER          = get_conf_option(conf, 'logs', 'sql-prefilter', False)
+LIKE_PATTERN_MIN_LEN        = 3     # shorter ones cannot use the trigram index
+
+def escape_like_pattern(s):
+    return s.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_')
+
+# Conservative translation of a python regular expression into SQL
+# LIKE patterns: any line matching the regular expression also matches
+# all these patterns (but the reverse is not true).
+# We only consider literal strings at the top level of the regular
+# expression, and the start anchor.
+def get_like_patterns(regexp):
+    try:
+        parsed = sre_parse.parse(regexp)
+    except Exception:
+        return ()
+    state = getattr(parsed, 'state', None) or parsed.pattern
+    if state.flags & (re.IGNORECASE | re.MULTILINE):
+        return ()
+    items = list(parsed)
+    anchored = len(items) > 0 and items[0] in (
+                    (sre_parse.AT, sre_parse.AT_BEGINNING),
+                    (sre_parse.AT, sre_parse.AT_BEGINNING_STRING))
+    patterns, literal = [], None
+    for index, (op, av) in enumerate(items + [(None, None)]):
+        if op == sre_parse.LITERAL:
+            if literal is None:
+                literal = ''
+                literal_anchored = anchored and index == 1
+            literal += chr(av)
+        elif literal is not None:
+            if literal_anchored:
+                patterns.append(escape_like_pattern(literal) + '%')
+            elif len(literal) >= LIKE_PATTERN_MIN_LEN:
+                patterns.append('%' + escape_like_pattern(literal) + '%')
+            literal = None
+    return tuple(patterns)
+
+# Logs queries are issued by the main thread (ServerDB) and by
+# the blocking threads, which have their own connection (cf. BlockingDB).
+class LogsQueriesDB(PostgresDB):
+
+    def format_logs_query(self, projections, ordering=None, \
+                    senders=None, history=(None,None), stream_ids=None,
+                    line_patterns=(), **kwargs):
+        args = []
+        constraints = [ 's.sender_mac = d.mac', 'l.stream_id = s.id' ]
+        if stream_ids is not None:
+            if len(stream_ids) == 0:
+                constraints.append('FALSE')     # no matching stream
+            else:
+                stream_ids_sql = '''(%s)''' % ",".join(
+                    str(stream_id) for stream_id in stream_ids)
+                constraints.append('s.id IN %s' % stream_ids_sql)
+        for pattern in line_patterns:
+            constraints.append('l.line LIKE %s')
+            args.append(pattern)
+        if senders:
+            sender_names = '''('%s')''' % "','".join(senders)
+            constraints.append('d.name IN %s' % sender_names)
+        start, end = history
+        if start:
+            constraints.append('l.timestamp > %s')
+            args.append(start)
+        if end:
+            constraints.append('l.timestamp < %s')
+            args.append(end)
+        where_clause = self.get_where_clause_from_constraints(constraints)
+        if ordering:
+            ordering = 'order by ' + ordering
+        else:
+            ordering = ''
+        return ("SELECT %s FROM devices d, logstreams s, logs l %s %s;" % \
+                                (projections, where_clause, ordering), args)
+
+class ServerDB(LogsQueriesDB):
 
     def __init__(self):
         # parent constructor
         PostgresDB.__init__(self)
+        self.flush_handlers = []
         # create the db schema
         self.execute("""CREATE TABLE IF NOT EXISTS devices (
                     mac TEXT PRIMARY KEY,
@@ -45,14 +152,136 @@ class ServerDB(PostgresDB):
                     id SERIAL PRIMARY KEY,
                     sender_mac TEXT REFERENCES devices(mac),
                     name TEXT);""")
-        self.execute("""CREATE TABLE IF NOT EXISTS logs (
-                    stream_id INTEGER REFERENCES logstreams(id),
-                    timestamp TIMESTAMP,
-                    line TEXT);""")
+        self.create_logs_table()
         self.execute("""CREATE TABLE IF NOT EXISTS checkpoints (
                     username TEXT,
                     timestamp TIMESTAMP,
                     name TEXT);""")
+        # the schema is ready, cache table column names
+        self.load_column_names()
+
+    def create_logs_table(self):
+        res = self.execute("""SELECT relkind FROM pg_class
+                              WHERE relname = 'logs';""").fetchall()
+        legacy_table = len(res) > 0 and res[0].relkind == 'r'
+        if legacy_table:
+            # logs table was created by a previous version of walt,
+            # without partitioning. It will become the oldest partition.
+            self.execute("ALTER TABLE logs RENAME TO %s;" % LOGS_LEGACY_PARTITION)
+        self.execute("""CREATE TABLE IF NOT EXISTS logs (
+                    stream_id INTEGER REFERENCES logstreams(id),
+                    timestamp TIMESTAMP,
+                    line TEXT) PARTITION BY RANGE (timestamp);""")
+        # this index is automatically created on each partition
+        self.execute("""CREATE INDEX IF NOT EXISTS logs_stream_id_timestamp
+                        ON logs (stream_id, timestamp);""")
+        self.execute("""CREATE TABLE IF NOT EXISTS %s
+                        PARTITION OF logs DEFAULT;""" % LOGS_DEFAULT_PARTITION)
+        if legacy_table:
+            bound = self.get_logs_partition_start(datetime.now())
+            # records not covered by the legacy partition go to the
+            # default partition (for now).
+            constraint = 'timestamp IS NULL OR timestamp >= %s'
+            self.execute("""INSERT INTO logs SELECT * FROM %s WHERE %s;""" % \
+                            (LOGS_LEGACY_PARTITION, constraint), (bound,))
+            self.execute("""DELETE FROM %s WHERE %s;""" % \
+                            (LOGS_LEGACY_PARTITION, constraint), (bound,))
+            self.execute("""ALTER TABLE logs ATTACH PARTITION %s
+                            FOR VALUES FROM (MINVALUE) TO ('%s');""" % \
+                            (LOGS_LEGACY_PARTITION, bound.strftime(LOGS_BOUND_FORMAT)))
+        self.update_logs_partitions()
+        self.commit()
+        if LOGS_SQL_PREFILTER:
+            try:
+                self.execute("CREATE EXTENSION IF NOT EXISTS pg_trgm;")
+                self.execute("""CREATE INDEX IF NOT EXISTS logs_line_trgm
+                                ON logs USING gin (line gin_trgm_ops);""")
+                self.commit()
+            except psycopg2.Error as e:
+                self.conn.rollback()
+                print('Warning: could not create trigram index on logs: %s' % e)
+        # the logs table may have been migrated
+        self.invalidate_schema_cache()
+
+    def get_logs_partition_start(self, ts):
+        day = ts.date()
+        # align on LOGS_PARTITION_DAYS (with weekly partitions,
+        # this means partitions start on mondays)
+        day -= timedelta(days = (day.toordinal() - 1) % LOGS_PARTITION_DAYS)
+        return datetime(day.year, day.month, day.day)
+
+    # return a dict <partition_name> -> <upper_bound>
+    # (upper_bound is None for the default partition)
+    def get_logs_partitions(self):
+        partitions = {}
+        for row in self.execute("""
+                SELECT c.relname as name,
+                       pg_get_expr(c.relpartbound, c.oid) as bound
+                FROM pg_inherits i, pg_class c, pg_class p
+                WHERE i.inhrelid = c.oid AND i.inhparent = p.oid
+                  AND p.relname = 'logs';""").fetchall():
+            match = LOGS_BOUND_REGEXP.search(row.bound)
+            if match is None:
+                partitions[row.name] = None
+            else:
+                partitions[row.name] = datetime.strptime(
+                                        match.group(1), LOGS_BOUND_FORMAT)
+        return partitions
+
+    def create_logs_partition(self, start, end):
+        name = start.strftime(LOGS_PARTITION_PATTERN)
+        constraint = 'timestamp >= %s AND timestamp < %s'
+        self.execute("""CREATE TABLE %s (LIKE logs INCLUDING DEFAULTS);""" % name)
+        # the default partition may hold records of this range, move them
+        self.execute("""INSERT INTO %s SELECT * FROM %s WHERE %s;""" % \
+                        (name, LOGS_DEFAULT_PARTITION, constraint), (start, end))
+        self.execute("""DELETE FROM %s WHERE %s;""" % \
+                        (LOGS_DEFAULT_PARTITION, constraint), (start, end))
+        # note: partition bounds must be literals
+        self.execute("""ALTER TABLE logs ATTACH PARTITION %s
+                        FOR VALUES FROM ('%s') TO ('%s');""" % (name,
+                            start.strftime(LOGS_BOUND_FORMAT),
+                            end.strftime(LOGS_BOUND_FORMAT)))
+
+    # create upcoming partitions and drop the ones which are
+    # out of the retention period.
+    def update_logs_partitions(self):
+        self.flush()
+        partitions = self.get_logs_partitions()
+        now = datetime.now()
+        start = self.get_logs_partition_start(now)
+        period = timedelta(days = LOGS_PARTITION_DAYS)
+        # upper bound of the time range already covered by partitions
+        # (comparing with this bound instead of checking partition names
+        # avoids overlaps if LOGS_PARTITION_DAYS was changed)
+        covered = max((end for end in partitions.values() if end is not None),
+                      default = start)
+        schema_changed = False
+        for i in range(LOGS_PARTITIONS_AHEAD + 1):
+            end = start + period
+            if start >= covered:
+                self.create_logs_partition(start, end)
+                schema_changed = True
+            start = end
+        if LOGS_RETENTION_DAYS is not None:
+            limit = now - timedelta(days = LOGS_RETENTION_DAYS)
+            for name, end in partitions.items():
+                if end is not None and end <= limit:
+                    self.execute("DROP TABLE %s;" % name)
+                    schema_changed = True
+            self.execute("DELETE FROM %s WHERE timestamp < %%s;" % \
+                            LOGS_DEFAULT_PARTITION, (limit,))
+        if schema_changed:
+            self.invalidate_schema_cache()
+        self.commit()
+
+    def plan_logs_maintenance(self, ev_loop):
+        ev_loop.plan_event(
+            ts = time() + EV_LOGS_MAINTENANCE_PERIOD,
+            target = self,
+            repeat_delay = EV_LOGS_MAINTENANCE_PERIOD,
+            ev_type = EV_LOGS_MAINTENANCE
+        )
 
     # Some types of events are numerous and commiting the
     # database each time would be costly.
@@ -66,16 +295,24 @@ class ServerDB(PostgresDB):
         )
 
     def handle_planned_event(self, ev_type):
-        assert(ev_type == EV_AUTO_COMMIT)
-        self.commit()
+        if ev_type == EV_AUTO_COMMIT:
+            self.flush()
+            self.commit()
+        elif ev_type == EV_LOGS_MAINTENANCE:
+            self.update_logs_partitions()
 
-    def get_logs(self, cursor_name, **kwargs):
-        sql, args = self.format_logs_query('l.*', ordering='l.timestamp', **kwargs)
-        cursor = self.server_cursors[cursor_name]
-        cursor.execute(sql, args)
-        return cursor
+    # Some components buffer records in memory and write them
+    # in groups (e.g. logs). They register here in order to have
+    # their flush() method called before each auto-commit.
+    def register_flush_handler(self, handler):
+        self.flush_handlers.append(handler)
+
+    def flush(self):
+        for handler in self.flush_handlers:
+            handler.flush()
 
     def count_logs(self, **kwargs):
+        self.flush()
         sql, args = self.format_logs_query('count(*)', **kwargs)
         return self.execute(sql, args).fetchall()[0][0]
 
@@ -89,33 +326,9 @@ class ServerDB(PostgresDB):
                         WHERE s.sender_mac = d.mac AND d.name IN %s;""" % sender_names
             return self.execute(sql)
 
-    def format_logs_query(self, projections, ordering=None, \
-                    senders=None, history=(None,None), stream_ids=None, **kwargs):
-        args = []
-        constraints = [ 's.sender_mac = d.mac', 'l.stream_id = s.id' ]
-        if stream_ids:
-            stream_ids_sql = '''(%s)''' % ",".join(
-                str(stream_id) for stream_id in stream_ids)
-            constraints.append('s.id IN %s' % stream_ids_sql)
-        if senders:
-            sender_names = '''('%s')''' % "','".join(senders)
-            constraints.append('d.name IN %s' % sender_names)
-        start, end = history
-        if start:
-            constraints.append('l.timestamp > %s')
-            args.append(start)
-        if end:
-            constraints.append('l.timestamp < %s')
-            args.append(end)
-        where_clause = self.get_where_clause_from_constraints(constraints)
-        if ordering:
-            ordering = 'order by ' + ordering
-        else:
-            ordering = ''
-        return ("SELECT %s FROM devices d, logstreams s, logs l %s %s;" % \
-                                (projections, where_clause, ordering), args)
-
     def forget_device(self, dev_name):
+        # pending logs of this device must reach the db before we delete them
+        self.flush()
         self.execute("""
             DELETE FROM logs l USING devices d, logstreams s
                 WHERE d.name = %s AND s.sender_mac = d.mac AND l.stream_id = s.id;
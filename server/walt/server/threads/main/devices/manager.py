@@ -72,8 +72,9 @@ Use 'walt device admin <name>' to fix this."""
 
 class DevicesManager(object):
 
-    def __init__(self, db):
+    def __init__(self, db, device_renamed_cb):
         self.db = db
+        self.device_renamed = device_renamed_cb
         self.server_ip = get_server_ip()
         self.netmask = str(get_walt_subnet().netmask)
 
@@ -95,6 +96,7 @@ class DevicesManager(object):
         # all is fine, let's update it
         self.db.update("devices", 'mac', mac = device_info.mac, name = new_name)
         self.db.commit()
+        self.device_renamed(device_info.mac, new_name)
 
     def get_type(self, mac):
         device_info = self.db.select_unique("devices", mac=mac)
@@ -204,6 +206,8 @@ class DevicesManager(object):
             if len(updates) > 0:
                 modified = True
                 self.db.update("devices", 'mac', mac=args_data['mac'], **updates)
+                if 'name' in updates:
+                    self.device_renamed(args_data['mac'], name)
         else:
             # device was not known in db yet
             # generate a name for this device
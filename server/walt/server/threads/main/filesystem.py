@@ -11,6 +11,12 @@ class Filesystem(object):
         ) + ' 2>/dev/null || true'
     def run_cmd(self, cmd):
         return check_output(self.wrap_cmd(cmd), shell=True)
+    # several commands may be run within a 'with' block
+    # (cf. ImageFilesystem)
+    def __enter__(self):
+        return self
+    def __exit__(self, type, value, traceback):
+        pass
     def ping(self):
         return self.run_cmd('echo ok').strip() == b'ok'
     def get_file_type(self, path):
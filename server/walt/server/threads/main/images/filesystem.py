@@ -0,0 +1,62 @@
+import os, stat, errno
+from walt.server.threads.main.filesystem import Filesystem
+
+MAX_SYMLINKS = 40
+
+# Resolve <path> in the image filesystem mounted at <root>, and return
+# the corresponding path on the server.
+# Symlinks are resolved as if <root> was '/' (i.e. as in a container),
+# thus absolute links of the image never lead to files of the server.
+def resolve_image_path(root, path, follow_last = True):
+    parts = [ p for p in path.split('/') if p not in ('', '.') ]
+    resolved = []
+    num_links = 0
+    while len(parts) > 0:
+        part = parts.pop(0)
+        if part == '..':
+            if len(resolved) > 0:
+                resolved.pop()
+            continue
+        host_path = os.path.join(root, *(resolved + [part]))
+        if (len(parts) > 0 or follow_last) and os.path.islink(host_path):
+            num_links += 1
+            if num_links > MAX_SYMLINKS:
+                raise OSError(errno.ELOOP, os.strerror(errno.ELOOP), path)
+            target = os.readlink(host_path)
+            if target.startswith('/'):
+                resolved = []
+            parts = [ p for p in target.split('/') if p not in ('', '.') ] + parts
+            continue
+        resolved.append(part)
+    return os.path.join(root, *resolved)
+
+# Filesystem of an image, inspected directly on its mounted tree
+# (instead of running a container for each command).
+class ImageFilesystem(Filesystem):
+    def __init__(self, image):
+        self.image = image
+        self.mount = None
+    # several checks may be done within a single temporary mount:
+    # with image.filesystem:
+    #     ...
+    def __enter__(self):
+        self.mount = self.image.ensure_temporary_mount()
+        self.mount.__enter__()
+        return self
+    def __exit__(self, type, value, traceback):
+        mount, self.mount = self.mount, None
+        mount.__exit__(type, value, traceback)
+    def ping(self):
+        return True
+    def get_file_type(self, path):
+        with self.image.ensure_temporary_mount():
+            try:
+                host_path = resolve_image_path(self.image.mount_path, path)
+                mode = os.lstat(host_path).st_mode
+            except OSError:
+                return None
+        if stat.S_ISREG(mode):
+            return 'f'
+        if stat.S_ISDIR(mode):
+            return 'd'
+        return 'o'  # other
@@ -1,7 +1,7 @@
-import os, re, time, shutil, shlex
+import os, re, time, shutil, shlex, uuid
 from plumbum.cmd import chroot
 from walt.server.threads.main.network.tools import get_server_ip
-from walt.server.threads.main.filesystem import Filesystem
+from walt.server.threads.main.images.filesystem import ImageFilesystem
 from walt.server.threads.main.images.setup import setup
 from walt.common.tools import \
         failsafe_makedirs, succeeds
@@ -87,8 +87,6 @@ def validate_image_name(requester, image_name):
     requester.stderr.write(ERROR_BAD_IMAGE_NAME)
     return False
 
-FS_CMD_PATTERN = 'docker run --rm --entrypoint %%(prog)s %(image)s %%(prog_args)s'
-
 class NodeImage(object):
     def __init__(self, db, docker, fullname, created_at = None):
         self.db = db
@@ -99,7 +97,7 @@ class NodeImage(object):
         self.mount_path = None
         self.mounted = False
         self.server_ip = get_server_ip()
-        self.filesystem = Filesystem(FS_CMD_PATTERN % dict(image = self.fullname))
+        self.filesystem = ImageFilesystem(self)
         self.task_label = None
     def rename(self, fullname):
         self.fullname, self.user, self.name = parse_image_fullname(fullname)
@@ -145,6 +143,12 @@ class NodeImage(object):
                 if self.mount_required:
                     self.image.os_unmount()
         return TemporaryMount(self)
+    # Private view of the image filesystem, mounted at a dedicated path.
+    # It does not interfere with the mount used by nodes (cf. mount()),
+    # thus it may be released later by another thread (e.g. at the end
+    # of a file transfer).
+    def private_mount(self):
+        return PrivateImageMount(self)
     def chroot(self, cmd):
         with self.ensure_temporary_mount():
             args = shlex.split(cmd)
@@ -161,19 +165,34 @@ class NodeImage(object):
         setup(self)
         print('Mounting %s... done' % self.fullname)
     def os_unmount(self):
-        while not succeeds('umount %s 2>/dev/null' % self.mount_path):
-            time.sleep(0.1)
-        while True:
-            try:
-                shutil.rmtree(self.diff_path)
-            except OSError:
-                time.sleep(0.1)
-                continue
-            break
-        os.rmdir(self.mount_path)
+        umount_image_fs(self.mount_path, self.diff_path)
         self.mounted = False
     def unmount(self):
         print('Un-mounting %s...' % self.fullname, end=' ')
         self.os_unmount()
         print('done')
 
+def umount_image_fs(mount_path, diff_path):
+    while not succeeds('umount %s 2>/dev/null' % mount_path):
+        time.sleep(0.1)
+    while True:
+        try:
+            shutil.rmtree(diff_path)
+        except OSError:
+            time.sleep(0.1)
+            continue
+        break
+    os.rmdir(mount_path)
+
+class PrivateImageMount(object):
+    def __init__(self, image):
+        image_dir = os.path.dirname(image.get_mount_info()[0])
+        self.base_path = '%s/private/%s' % (image_dir, uuid.uuid4().hex)
+        self.mount_path = self.base_path + '/fs'
+        self.diff_path = self.base_path + '/diff'
+        failsafe_makedirs(self.mount_path)
+        failsafe_makedirs(self.diff_path)
+        image.docker.local.image_mount(image.fullname, self.diff_path, self.mount_path)
+    def release(self):
+        umount_image_fs(self.mount_path, self.diff_path)
+        os.rmdir(self.base_path)
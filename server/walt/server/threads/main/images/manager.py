@@ -54,7 +54,8 @@ class NodeImageManager(object):
     def get_cp_entity_filesystem(self, requester, image_name):
         return self.store.get_user_image_from_name(requester, image_name).filesystem
     def get_cp_entity_attrs(self, requester, image_name):
-        return dict(image_name=image_name)
+        image = self.store.get_user_image_from_name(requester, image_name)
+        return dict(image_name=image_name, image_fullname=image.fullname)
     def fix_owner(self, requester, other_user):
         fix_owner(self.store, self.docker, requester, other_user)
     def cleanup(self):
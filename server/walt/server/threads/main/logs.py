@@ -1,42 +1,162 @@
-import re, pickle
+import re, pickle, threading
+from collections import deque
 from datetime import datetime
+from select import select, POLLOUT
 from walt.common.constants import WALT_SERVER_NETCONSOLE_PORT
-from walt.common.tcp import read_pickle, write_pickle, \
-                            Requests
+from walt.common.evloop import POLL_OPS_READ
+from walt.common.logs import COMPACT_FRAMING_MAGIC, FRAME_HEADER, \
+                encode_frame, encode_stream_entry, encode_record_entry
+from walt.common.tcp import read_pickle, Requests
 from walt.common.udp import udp_server_socket
+from walt.server import conf
+from walt.server.conf import get_conf_option
+from walt.server.threads.main.db import LOGS_SQL_PREFILTER, get_like_patterns
+
+# Log lines are not inserted in db one at a time: they are buffered
+# and written with a multi-row insert when LOGS_FLUSH_SIZE lines are
+# pending. The buffer is also flushed on each db auto-commit, thus a
+# log line waits at most EV_AUTO_COMMIT_PERIOD seconds (cf. db.py)
+# before being visible to history queries (cf. stream_db_logs()).
+LOGS_FLUSH_SIZE = 256
+LOGS_COLUMNS = ('stream_id', 'timestamp', 'line')
 
 class LogsToDBHandler(object):
     def __init__(self, db):
         self.db = db
+        self.buffer = []
+        db.register_flush_handler(self)
 
-    def log(self, **record):
-        self.db.insert('logs', **record)
+    def accepts_stream(self, stream_id):
+        return True     # we record all logs
+
+    def log(self, stream_id, timestamp, line, **kwargs):
+        self.buffer.append((stream_id, timestamp, line))
+        if len(self.buffer) >= LOGS_FLUSH_SIZE:
+            self.flush()
+
+    def flush(self):
+        if len(self.buffer) == 0:
+            return
+        # reset the buffer first, in order to not retry
+        # the same records forever if the insert fails
+        records, self.buffer = self.buffer, []
+        failed = self.db.insert_multiple('logs', LOGS_COLUMNS, records)
+        if len(failed) > 0:
+            # invalid records (e.g. a stream removed meanwhile)
+            print('Could not save %d log line(s) in db, they were dropped.' % \
+                    len(failed))
+
+# Metadata of log streams (sender name, stream name, sender mac),
+# cached in memory in order to avoid db queries when handling log lines.
+# It is loaded at startup, and kept up to date when streams are
+# registered and when devices are renamed or forgotten.
+class LogStreamsCache(object):
+    def __init__(self, db):
+        self.db = db
+        self.reload()
+
+    def reload(self):
+        self.streams = {}       # stream_id -> dict(sender=..., stream=...)
+        self.macs = {}          # stream_id -> sender_mac
+        self.stream_ids = {}    # (sender_mac, stream_name) -> stream_id
+        for row in self.db.execute("""
+                SELECT s.id, s.name, s.sender_mac, d.name as sender
+                FROM logstreams s LEFT JOIN devices d ON s.sender_mac = d.mac;
+                """).fetchall():
+            self.add(row.id, row.sender_mac, row.sender, row.name)
+
+    def add(self, stream_id, sender_mac, sender_name, stream_name):
+        self.streams[stream_id] = dict(sender = sender_name, stream = stream_name)
+        self.macs[stream_id] = sender_mac
+        # streams of unknown senders are not shared: each of them gets
+        # a new stream (cf. get_stream_id())
+        if sender_mac is not None:
+            self.stream_ids[(sender_mac, stream_name)] = stream_id
+
+    # return dict(sender=..., stream=...) or None if stream is unknown
+    def get_info(self, stream_id):
+        return self.streams.get(stream_id)
 
+    # return an iterator over (stream_id, stream_info) tuples
+    def get_streams(self):
+        return self.streams.items()
+
+    # return the id of this stream, after registering it if needed
+    def get_stream_id(self, sender_mac, sender_name, stream_name):
+        stream_id = self.stream_ids.get((sender_mac, stream_name))
+        if stream_id is None:
+            stream_id = self.db.insert('logstreams', returning='id',
+                            sender_mac = sender_mac, name = stream_name)
+            self.add(stream_id, sender_mac, sender_name, stream_name)
+        return stream_id
+
+    def get_sender_stream_ids(self, sender_mac):
+        return tuple(stream_id for stream_id, mac in self.macs.items() \
+                        if mac == sender_mac)
+
+    def rename_sender(self, sender_mac, sender_name):
+        for stream_id in self.get_sender_stream_ids(sender_mac):
+            self.streams[stream_id] = dict(self.streams[stream_id],
+                                            sender = sender_name)
+
+    def forget_sender(self, sender_mac):
+        for stream_id in self.get_sender_stream_ids(sender_mac):
+            stream_info = self.streams.pop(stream_id, None)
+            self.macs.pop(stream_id, None)
+            if stream_info is not None:
+                # the db may hold several streams with the same
+                # (sender_mac, name), they share this entry.
+                self.stream_ids.pop((sender_mac, stream_info['stream']), None)
+
+# LogsHub dispatches each log line to the handlers interested in
+# its stream. For efficiency, the set of handlers interested in a given
+# stream is computed once (by calling handler.accepts_stream()) and
+# stored in self.stream_handlers. This index is reset when a new handler
+# is added, or when stream metadata changes.
 class LogsHub(object):
     def __init__(self):
         self.handlers = set([])
+        self.stream_handlers = {}
 
     def addHandler(self, handler):
         self.handlers.add(handler)
+        self.reset_index()
+
+    def reset_index(self):
+        self.stream_handlers = {}
 
     def removeHandler(self, handler):
         self.handlers.remove(handler)
+        for handlers in self.stream_handlers.values():
+            handlers.discard(handler)
+
+    def get_stream_handlers(self, stream_id):
+        handlers = self.stream_handlers.get(stream_id)
+        if handlers is None:
+            handlers = set(handler for handler in self.handlers \
+                                if handler.accepts_stream(stream_id))
+            self.stream_handlers[stream_id] = handlers
+        return handlers
 
     def log(self, **kwargs):
         to_be_removed = set([])
-        for handler in self.handlers:
+        for handler in self.get_stream_handlers(kwargs['stream_id']):
             res = handler.log(**kwargs)
             # a handler may request to be deleted
             # by returning False
             if res == False:
                 to_be_removed.add(handler)
         for handler in to_be_removed:
-            self.handlers.remove(handler)
+            self.removeHandler(handler)
 
 class LogsStreamListener(object):
-    def __init__(self, db, hub, sock_file, **kwargs):
+    # handle_event() reads until no data is pending
+    # (sock_file is unbuffered, thus select() is accurate)
+    edge_triggered = True
+    def __init__(self, db, hub, streams, sock_file, **kwargs):
         self.db = db
         self.hub = hub
+        self.streams = streams
         self.sock_file = sock_file
         self.stream_id = None
         self.server_timestamps = None
@@ -48,37 +168,43 @@ class LogsStreamListener(object):
         sender_ip, sender_port = self.sock_file.getpeername()
         sender_info = self.db.select_unique('devices', ip = sender_ip)
         if sender_info == None:
-            sender_mac = None
-        else:
-            sender_mac = sender_info.mac
-        stream_info = self.db.select_unique('logstreams',
-                            sender_mac = sender_mac, name = name)
-        if stream_info:
-            # found existing stream
-            stream_id = stream_info.id
+            sender_mac, sender_name = None, None
         else:
-            # register new stream
-            stream_id = self.db.insert('logstreams', returning='id',
-                            sender_mac = sender_mac, name = name)
+            sender_mac, sender_name = sender_info.mac, sender_info.name
+        stream_id = self.streams.get_stream_id(sender_mac, sender_name, name)
         # these are not needed anymore
         self.db = None
+        self.streams = None
         return stream_id
 
     # let the event loop know what we are reading on
     def fileno(self):
         return self.sock_file.fileno()
     # when the event loop detects an event for us, we
-    # know a log line should be read.
+    # know log lines should be read.
     def handle_event(self, ts):
+        while True:
+            if self.handle_line(ts) == False:
+                return False
+            try:
+                fd = self.sock_file.fileno()
+                rlist, wlist, elist = select((fd,), (), (), 0)
+            except (OSError, ValueError):
+                return False
+            if len(rlist) == 0:
+                return True     # nothing more pending
+    def handle_line(self, ts):
         if self.stream_id == None:
             self.stream_id = self.register_stream()
             # register_stream() involves a read on the stream
             # to get its name.
             # supposedly that's why we have been woken up.
-            # let the event loop call us again if there is more.
             return True
         try:
-            inputline = self.sock_file.readline().strip().decode('UTF-8')
+            inputline = self.sock_file.readline()
+            if len(inputline) == 0:
+                return False    # end of input
+            inputline = inputline.strip().decode('UTF-8')
             if inputline == 'CLOSE':
                 return False    # stop here
             if self.server_timestamps:
@@ -109,9 +235,10 @@ class LogsStreamListener(object):
 class NetconsoleListener(object):
     """Listens for netconsole messages sent by nodes over UDP, and store
     them as regular logs."""
-    def __init__(self, db, hub, port, **kwargs):
+    def __init__(self, db, hub, streams, port, **kwargs):
         self.db = db
         self.hub = hub
+        self.streams = streams
         self.s = udp_server_socket(port)
         self.sender_info = dict()
 
@@ -133,19 +260,10 @@ class NetconsoleListener(object):
             # database for each received netconsole message.
             sender_info = self.db.select_unique('devices', ip=sender_ip)
             if sender_info == None:
-                sender_mac = None
-                stream_info = None
-            else:
-                sender_mac = sender_info.mac
-                stream_info = self.db.select_unique('logstreams', sender_mac=sender_mac,
-                                                    name='netconsole')
-            if stream_info:
-                # found existing stream
-                stream_id = stream_info.id
+                sender_mac, sender_name = None, None
             else:
-                # register new stream
-                stream_id = self.db.insert('logstreams', returning='id',
-                                           sender_mac=sender_mac, name='netconsole')
+                sender_mac, sender_name = sender_info.mac, sender_info.name
+            stream_id = self.streams.get_stream_id(sender_mac, sender_name, 'netconsole')
             # Second list element is the current pending message for this sender
             # (in some cases we may receive a line in multiple parts before getting
             # the end-of-line char)
@@ -173,19 +291,59 @@ class NetconsoleListener(object):
     def close(self):
         self.s.close()
 
+# Records sent to a log client are queued in an outgoing buffer, which
+# is drained when the client socket is writable. This buffer is limited
+# to LOGS_CLIENT_BUFFER_SIZE bytes. When a client reads too slowly and
+# realtime logs overflow its buffer, the overflow policy applies:
+# - 'drop-oldest': the oldest pending records are discarded,
+# - 'disconnect': the client is disconnected,
+# - 'skip-marker': new records are discarded, and a marker record
+#   indicating the number of lines skipped is sent when possible.
+# History records are never discarded: instead, when
+# write_history_to_client() returns LOGS_BUFFER_FULL, the blocking thread
+# waits on the 'buffer_drained' event of the handler, which is set when
+# the buffer is drained below LOGS_CLIENT_BUFFER_LOW_MARK bytes (or when
+# the handler is closed).
+# These values may be set in the "logs" section of the server conf.
+LOGS_CLIENT_BUFFER_SIZE = get_conf_option(conf, 'logs', 'client-buffer-size', 1024*1024)
+LOGS_CLIENT_OVERFLOW_POLICY = get_conf_option(conf, 'logs', 'client-overflow-policy', 'skip-marker')
+LOGS_CLIENT_BUFFER_LOW_MARK = LOGS_CLIENT_BUFFER_SIZE // 2
+LOGS_BUFFER_FULL = 'BUFFER_FULL'
+
+# With compact framing (cf. walt/common/logs.py), records are grouped
+# in frames of up to LOGS_FRAME_SIZE bytes, sent with a single syscall.
+LOGS_FRAME_SIZE = 64*1024
+# stream used for records generated by the server itself
+SERVER_STREAM = (0, 'walt-server', 'logs')
+
 PHASE_WAIT_FOR_BLCK_THREAD = 0
 PHASE_RETRIEVING_FROM_DB = 1
 PHASE_SENDING_TO_CLIENT = 2
 class LogsToSocketHandler(object):
-    def __init__(self, db, hub, sock_file, blocking, **kwargs):
+    def __init__(self, db, hub, streams, sock_file, blocking, ev_loop, **kwargs):
         self.db = db
+        self.streams = streams
         self.sock_file = sock_file
-        self.cache = {}
+        self.streams_matching = {}
         self.params = None
         self.hub = hub
         self.blocking = blocking
+        self.ev_loop = ev_loop
         self.phase = None
         self.realtime_buffer = []
+        self.compact = False
+        self.defined_streams = set()
+        self.batch = bytearray()    # compact framing: frame being filled
+        self.batch_streams = []     # streams defined in self.batch
+        # out_chunks items are tuples (<data>, <streams defined in data>)
+        self.out_chunks = deque()
+        self.out_offset = 0     # bytes of out_chunks[0] already sent
+        self.out_size = 0       # bytes pending in out_chunks and batch
+        self.skipped = 0
+        self.waiting_writable = False
+        self.closing = False
+        self.buffer_drained = threading.Event()
+        self.buffer_drained.set()
         #sock.settimeout(1.0)
     def log(self, **record):
         if self.phase == PHASE_WAIT_FOR_BLCK_THREAD:
@@ -202,6 +360,10 @@ class LogsToSocketHandler(object):
         elif self.phase == PHASE_SENDING_TO_CLIENT:
             return self.write_to_client(**record)
     def notify_history_processing_startup(self):
+        # logs buffered before this point must be retrieved
+        # from db by the blocking thread, so write and commit them now.
+        self.db.flush()
+        self.db.commit()
         self.phase = PHASE_RETRIEVING_FROM_DB
     def notify_history_processed(self):
         if self.params['realtime']:
@@ -213,51 +375,204 @@ class LogsToSocketHandler(object):
             # notify that next logs can be sent
             # directly to the client
             self.phase = PHASE_SENDING_TO_CLIENT
+        elif self.out_size > 0:
+            # no realtime mode, we can quit when
+            # the outgoing buffer is empty
+            self.closing = True
         else:
             # no realtime mode, we can quit
-            self.close()
-    def write_to_client(self, stream_id, senders_filtered=False, **record):
-        try:
-            if stream_id not in self.cache:
-                self.cache[stream_id] = self.db.execute(
-                """SELECT d.name as sender, s.name as stream
-                   FROM logstreams s, devices d
-                   WHERE s.id = %s
-                     AND s.sender_mac = d.mac
-                """ % stream_id).fetchall()[0]._asdict()
-            stream_info = self.cache[stream_id]
-            # when data comes from the db, senders are already filtered,
-            # while data coming from the hub has to be filtered.
-            if not senders_filtered:
-                if stream_info['sender'] not in self.params['senders']:
-                    return  # filter out
-            # matching the streams or the logline is always done here, otherwise
-            # there may be inconsistencies between the regexp format in the
-            # postgresql database and in python
+            self.ev_loop.remove_listener(self)
+    # called by the blocking thread
+    def get_buffer_drained_event(self):
+        return self.buffer_drained
+    # matching the streams or the logline is always done here, otherwise
+    # there may be inconsistencies between the regexp format in the
+    # postgresql database and in python.
+    # the result of the streams regexp is cached for each stream.
+    def stream_matches(self, stream_id, stream_info):
+        if stream_id not in self.streams_matching:
             if self.streams_regexp:
                 matches = self.streams_regexp.findall(stream_info['stream'])
-                if len(matches) == 0:
-                    return  # filter out
-            if self.logline_regexp:
-                matches = self.logline_regexp.findall(record['line'])
-                if len(matches) == 0:
-                    return  # filter out
+                self.streams_matching[stream_id] = (len(matches) > 0)
+            else:
+                self.streams_matching[stream_id] = True
+        return self.streams_matching[stream_id]
+    # called by the hub to know if we should receive the
+    # realtime logs of this stream
+    def accepts_stream(self, stream_id):
+        stream_info = self.streams.get_info(stream_id)
+        if stream_info is None:
+            return False
+        if stream_info['sender'] not in self.senders:
+            return False
+        return self.stream_matches(stream_id, stream_info)
+    def write_to_client(self, stream_id, senders_filtered=False, **record):
+        if self.filter_and_queue(stream_id, senders_filtered, record) == False:
+            return False
+        return self.flush_queue()
+    # called by the blocking thread with a list of
+    # (stream_id, timestamp, line) tuples from the db
+    def write_history_to_client(self, records):
+        for stream_id, timestamp, line in records:
+            record = dict(timestamp = timestamp, line = line)
+            if self.filter_and_queue(stream_id, True, record) == False:
+                return False
+        return self.flush_queue()
+    def filter_and_queue(self, stream_id, senders_filtered, record):
+        if self.sock_file.closed:
+            return False
+        stream_info = self.streams.get_info(stream_id)
+        if stream_info is None:
+            return  # unknown stream
+        # when data comes from the hub, senders and streams are already
+        # filtered (cf. accepts_stream()), while data coming from the db
+        # is only filtered by senders.
+        if senders_filtered:
+            if not self.stream_matches(stream_id, stream_info):
+                return  # filter out
+        if self.logline_regexp:
+            matches = self.logline_regexp.findall(record['line'])
+            if len(matches) == 0:
+                return  # filter out
+        # records coming from the db have senders_filtered=True
+        return self.queue_record(stream_id, stream_info, record,
+                                 history = senders_filtered)
+    def encode_record(self, stream_id, stream_info, record):
+        if self.compact:
+            streams = ()
+            data = b''
+            if stream_id not in self.defined_streams:
+                self.defined_streams.add(stream_id)
+                streams = ((stream_id, stream_info['sender'], stream_info['stream']),)
+                data = encode_stream_entry(*streams[0])
+            data += encode_record_entry(
+                        stream_id, record['timestamp'], record['line'])
+            return data, streams
+        else:
             d = {}
             d.update(record)
             d.update(stream_info)
-            if self.sock_file.closed:
-                raise IOError()
-            write_pickle(d, self.sock_file)
-        except IOError as e:
+            return pickle.dumps(d, pickle.HIGHEST_PROTOCOL), ()
+    def queue_data(self, data, streams):
+        if self.compact:
+            self.batch += data
+            self.batch_streams.extend(streams)
+            if len(self.batch) >= LOGS_FRAME_SIZE:
+                self.close_batch()
+        else:
+            self.out_chunks.append((data, streams))
+        self.out_size += len(data)
+    def close_batch(self):
+        if len(self.batch) > 0:
+            self.out_chunks.append((encode_frame(self.batch),
+                                    tuple(self.batch_streams)))
+            self.out_size += FRAME_HEADER.size
+            self.batch = bytearray()
+            self.batch_streams = []
+    def queue_record(self, stream_id, stream_info, record, history):
+        data, streams = self.encode_record(stream_id, stream_info, record)
+        if not history and self.out_size + len(data) > LOGS_CLIENT_BUFFER_SIZE:
+            if LOGS_CLIENT_OVERFLOW_POLICY == 'disconnect':
+                print("client log connection too slow, closing")
+                self.ev_loop.remove_listener(self)
+                return False
+            elif LOGS_CLIENT_OVERFLOW_POLICY == 'drop-oldest':
+                self.drop_oldest_chunks(len(data))
+            else:   # 'skip-marker'
+                if stream_id in (s[0] for s in streams):
+                    # stream definition was not sent
+                    self.defined_streams.discard(stream_id)
+                self.skipped += 1
+                return
+        if self.skipped > 0:
+            self.queue_skipped_marker()
+        self.queue_data(data, streams)
+    def flush_queue(self):
+        if not self.waiting_writable:
+            # try to send right now
+            if self.send_pending() == False:
+                return False
+        if self.out_size >= LOGS_CLIENT_BUFFER_SIZE:
+            self.buffer_drained.clear()
+            return LOGS_BUFFER_FULL
+    def drop_oldest_chunks(self, needed):
+        self.close_batch()
+        dropped_streams = []
+        # the 1st chunk may have been partially sent already, we keep it
+        while len(self.out_chunks) > 1 and \
+                self.out_size + needed > LOGS_CLIENT_BUFFER_SIZE:
+            chunk, streams = self.out_chunks[1]
+            del self.out_chunks[1]
+            self.out_size -= len(chunk)
+            dropped_streams.extend(streams)
+        if len(dropped_streams) > 0:
+            # next records may refer to these streams,
+            # so we must keep their definitions
+            frame = encode_frame(b''.join(
+                        encode_stream_entry(*s) for s in dropped_streams))
+            self.out_chunks.insert(1, (frame, tuple(dropped_streams)))
+            self.out_size += len(frame)
+    def queue_skipped_marker(self):
+        stream_id, sender, stream = SERVER_STREAM
+        record = dict(
+                timestamp = datetime.now(),
+                line = '[%d log lines skipped, client too slow]' % self.skipped)
+        self.skipped = 0
+        data, streams = self.encode_record(stream_id,
+                            dict(sender = sender, stream = stream), record)
+        self.queue_data(data, streams)
+    # send as much pending data as possible without blocking
+    def send_pending(self):
+        sock = self.sock_file.sock
+        self.close_batch()
+        try:
+            while len(self.out_chunks) > 0:
+                chunk = self.out_chunks[0][0]
+                sent = sock.send(memoryview(chunk)[self.out_offset:])
+                self.out_offset += sent
+                self.out_size -= sent
+                if self.out_offset < len(chunk):
+                    break   # socket buffer is full
+                self.out_chunks.popleft()
+                self.out_offset = 0
+        except BlockingIOError:
+            pass
+        except OSError:
             # the socket was supposedly closed.
             print("client log connection closing")
+            self.ev_loop.remove_listener(self)
             # notify the hub that we should be removed.
             return False
+        if self.out_size <= LOGS_CLIENT_BUFFER_LOW_MARK and \
+                not self.buffer_drained.is_set():
+            # let the blocking thread send more history records
+            self.buffer_drained.set()
+        if self.out_size == 0:
+            if self.skipped > 0:
+                self.queue_skipped_marker()
+                return self.send_pending()
+            if self.closing:
+                return False
+        # let the event loop notify us when the socket is
+        # writable, if and only if we have pending data
+        waiting_writable = self.out_size > 0
+        if waiting_writable != self.waiting_writable:
+            self.waiting_writable = waiting_writable
+            events = POLL_OPS_READ
+            if waiting_writable:
+                events |= POLLOUT
+            self.ev_loop.update_listener(self, events)
+    # the event loop detected the socket is writable
+    def handle_write_event(self, ts):
+        return self.send_pending()
     # let the event loop know what we are reading on
     def fileno(self):
         return self.sock_file.fileno()
     # this is what we will do depending on the client request params
-    def handle_params(self, history, realtime, senders, streams, logline_regexp):
+    # framing may be 'pickle' (one pickled dict per record, the default
+    # for older clients) or 'compact' (cf. walt/common/logs.py).
+    def handle_params(self, history, realtime, senders, streams, logline_regexp,
+                      framing = 'pickle'):
         if history:
             # unpickle the elements of the history range
             history = tuple(pickle.loads(e) if e else None for e in history)
@@ -272,6 +587,18 @@ class LogsToSocketHandler(object):
         self.params = dict( history = history,
                             realtime = realtime,
                             senders = senders)
+        self.senders = set(senders)
+        if history and LOGS_SQL_PREFILTER:
+            self.add_sql_prefilter(streams, logline_regexp)
+        # from now on, we only write on this socket, without blocking
+        self.sock_file.sock.setblocking(False)
+        if framing == 'compact':
+            # let the client know we support this mode
+            self.compact = True
+            self.out_chunks.append((COMPACT_FRAMING_MAGIC, ()))
+            self.out_size += len(COMPACT_FRAMING_MAGIC)
+            if self.send_pending() == False:
+                return
         if history:
             self.phase = PHASE_WAIT_FOR_BLCK_THREAD
             self.blocking.stream_db_logs(self)
@@ -279,6 +606,15 @@ class LogsToSocketHandler(object):
             self.phase = PHASE_SENDING_TO_CLIENT
         if realtime:
             self.hub.addHandler(self)
+    # let the db discard most non-matching records of the history
+    # (matching is still done in python afterwards, cf. filter_and_queue())
+    def add_sql_prefilter(self, streams, logline_regexp):
+        if streams:
+            self.params.update(stream_ids = tuple(
+                stream_id for stream_id, stream_info in self.streams.get_streams() \
+                        if self.stream_matches(stream_id, stream_info)))
+        if logline_regexp:
+            self.params.update(line_patterns = get_like_patterns(logline_regexp))
     # this is what we do when the event loop detects an event for us
     def handle_event(self, ts):
         if self.params == None:
@@ -288,6 +624,8 @@ class LogsToSocketHandler(object):
             return False    # no more communication is expected this way
     def close(self):
         self.sock_file.close()
+        # do not let the blocking thread wait forever
+        self.buffer_drained.set()
 
 class LogsManager(object):
     def __init__(self, db, tcp_server, blocking, ev_loop):
@@ -295,23 +633,34 @@ class LogsManager(object):
         self.blocking = blocking
         self.hub = LogsHub()
         self.hub.addHandler(LogsToDBHandler(db))
+        self.streams = LogStreamsCache(db)
         tcp_server.register_listener_class(
                     req_id = Requests.REQ_DUMP_LOGS,
                     cls = LogsToSocketHandler,
                     db = self.db,
                     hub = self.hub,
-                    blocking = self.blocking)
+                    streams = self.streams,
+                    blocking = self.blocking,
+                    ev_loop = ev_loop)
         tcp_server.register_listener_class(
                     req_id = Requests.REQ_NEW_INCOMING_LOGS,
                     cls = LogsStreamListener,
                     db = self.db,
-                    hub = self.hub)
-        self.netconsole = NetconsoleListener(self.db, self.hub, WALT_SERVER_NETCONSOLE_PORT)
+                    hub = self.hub,
+                    streams = self.streams)
+        self.netconsole = NetconsoleListener(self.db, self.hub, self.streams,
+                                             WALT_SERVER_NETCONSOLE_PORT)
         self.netconsole.join_event_loop(ev_loop)
 
     def forget_device(self, device_name):
         device_info = self.db.select_unique('devices', name=device_name)
         self.netconsole.forget_ip(device_info.ip)
+        self.streams.forget_sender(device_info.mac)
+        self.hub.reset_index()
+
+    def rename_device(self, device_mac, new_name):
+        self.streams.rename_sender(device_mac, new_name)
+        self.hub.reset_index()
 
     # Look for a checkpoint. Return a tuple.
     # If the result conforms to 'expected', return (True, <checkpoint_found_or_none>)
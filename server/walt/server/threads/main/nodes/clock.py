@@ -11,26 +11,27 @@ class NodesClockSyncInfo:
     """
     def __init__(self, ev_loop):
         self.ev_loop = ev_loop
-        self.tasks = {}
+        self.tasks = {}     # target_ts -> [ task, ... ]
 
     def sync(self, task):
         # busybox can set date with only 1-second granularity,
         # so we wait until next second change before returning result.
         task.set_async()   # result will be available later
-        task_id = id(task)
-        self.tasks[task_id] = task
         # compute time of next second change
         target_ts = int(time() + 1)     # round to next int
-        # plan event to be recalled at this time
-        self.ev_loop.plan_event(
-            ts = target_ts,
-            target = self,
-            task_id = task_id,
-            target_ts = target_ts
-        )
+        # all nodes requesting a sync during the same second get
+        # their result with a single planned event
+        if target_ts not in self.tasks:
+            self.tasks[target_ts] = []
+            # plan event to be recalled at this time
+            self.ev_loop.plan_event(
+                ts = target_ts,
+                target = self,
+                target_ts = target_ts
+            )
+        self.tasks[target_ts].append(task)
 
-    def handle_planned_event(self, task_id, target_ts):
-        # return timestamp and unblock the node
-        self.tasks[task_id].return_result(target_ts)
-        # cleanup
-        del self.tasks[task_id]
+    def handle_planned_event(self, target_ts):
+        # return timestamp and unblock the nodes
+        for task in self.tasks.pop(target_ts):
+            task.return_result(target_ts)
@@ -1,9 +1,10 @@
 #!/usr/bin/env python
 import socket
-from walt.common.io import read_and_copy
+from walt.common.io import StreamRelay
 from walt.common.tcp import read_pickle, Requests, client_sock_file
 
 class NodeExposeFeedbackListener:
+    edge_triggered = True   # relay_all() reads until no data is pending
     def __init__(self, env):
         self.env = env
     # let the event loop know what we are reading on
@@ -13,10 +14,9 @@ class NodeExposeFeedbackListener:
     # the node wrote something on the socket
     # we just have to copy this to the user socket
     def handle_event(self, ts):
-        return read_and_copy(
-                self.env.node_sock_file, self.env.client_sock_file)
+        return self.env.to_client.relay_all()
     def close(self):
-        self.env.close()
+        self.env.relay_ended(self.env.to_client)
 
 class NodeExposeSocketListener:
     REQ_ID = Requests.REQ_TCP_TO_NODE
@@ -25,6 +25,8 @@ class NodeExposeSocketListener:
         self.node_ip_and_port = None
         self.client_sock_file = sock_file
         self.node_sock_file = None
+        self.to_node, self.to_client = None, None
+        self.running_relays = 0
     def open_channel_to_node(self):
         return client_sock_file(*self.node_ip_and_port)
     def start(self):
@@ -34,6 +36,9 @@ class NodeExposeSocketListener:
             self.client_sock_file.write(b'Could not connect to %s:%d!\n' % \
                                     self.node_ip_and_port)
             return False    # we should close
+        self.to_node = StreamRelay(self.client_sock_file, self.node_sock_file)
+        self.to_client = StreamRelay(self.node_sock_file, self.client_sock_file)
+        self.running_relays = 2
         # create a new listener on the event loop for reading
         # what the node outputs
         feedback_listener = NodeExposeFeedbackListener(self)
@@ -59,9 +64,22 @@ class NodeExposeSocketListener:
         else:
             # otherwise we are all set. Thus, getting input data means
             # data was sent on the other end.
-            return read_and_copy(
-                self.client_sock_file, self.node_sock_file)
+            return self.to_node.relay()
+    # called when one direction of the forwarding is over
+    def relay_ended(self, relay):
+        # forward the end of input as a half-close: data may still
+        # flow the other way (e.g. a client waiting for a response).
+        relay.shutdown_output()
+        relay.close()
+        self.running_relays -= 1
+        if self.running_relays == 0:
+            self.close_files()
     def close(self):
+        if self.to_node is None:
+            self.close_files()  # forwarding was not started
+        else:
+            self.relay_ended(self.to_node)
+    def close_files(self):
         if self.client_sock_file:
             self.client_sock_file.close()
             self.client_sock_file = None
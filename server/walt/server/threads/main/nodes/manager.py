@@ -463,21 +463,40 @@ class NodesManager(object):
         return self.devices.as_device_set(n.name for n in nodes)
 
     def validate_cp(self, requester, src, dst):
-        return validate_cp("node", self, requester, src, dst)
+        info = validate_cp("node", self, requester, src, dst)
+        if info is not None and info['client_operand_index'] == 1 and \
+                len(info['node_targets']) > 1:
+            requester.stderr.write(
+                'Copying from a set of nodes is not allowed, please specify one node.\n')
+            return None
+        return info
 
-    def validate_cp_entity(self, requester, node_name):
-        return self.get_node_info(requester, node_name) != None
+    # when copying files to nodes, the destination may be a set of nodes
+    # (cf. BroadcastUpload in transfer.py)
+    def validate_cp_entity(self, requester, node_set):
+        nodes = self.parse_node_set(requester, node_set)
+        if nodes is None:
+            return False    # error already reported
+        for node in nodes:
+            if node.ip is None:
+                self.devices.notify_unknown_ip(requester, node.name)
+                return False
+        return True
 
-    def get_cp_entity_filesystem(self, requester, node_name):
-        node_ip = self.get_node_ip(requester, node_name)
-        self.prepare_ssh_access_for_ip(node_ip)
-        return Filesystem(FS_CMD_PATTERN % dict(node_ip = node_ip))
+    def get_cp_entity_filesystem(self, requester, node_set):
+        nodes = self.parse_node_set(requester, node_set)
+        for node in nodes:
+            self.prepare_ssh_access_for_ip(node.ip)
+        # with a set of nodes, paths are checked on the first one
+        return Filesystem(FS_CMD_PATTERN % dict(node_ip = nodes[0].ip))
 
-    def get_cp_entity_attrs(self, requester, node_name):
-        owned = not self.devices.includes_devices_not_owned(requester, node_name, True)
-        ip = self.get_node_ip(requester, node_name)
-        return dict(node_name = node_name,
-                    node_ip = ip,
+    def get_cp_entity_attrs(self, requester, node_set):
+        owned = not self.devices.includes_devices_not_owned(requester, node_set, True)
+        nodes = self.parse_node_set(requester, node_set)
+        node_ip = nodes[0].ip if len(nodes) == 1 else None
+        return dict(node_name = node_set,
+                    node_ip = node_ip,
+                    node_targets = tuple((node.name, node.ip) for node in nodes),
                     node_owned = owned)
 
     def netsetup_handler(self, requester, device_set, netsetup_value):
@@ -1,12 +1,14 @@
 #!/usr/bin/env python
 import os, pty, shlex, fcntl, termios, sys, threading, socket, signal
 from subprocess import Popen, STDOUT
-from walt.common.io import SmartFile, read_and_copy
+from walt.common.io import SmartFile, StreamRelay
 from walt.common.tcp import read_pickle
+from walt.common.thread import WakeupFd
 from walt.common.tty import set_tty_size_raw
 from walt.common.tools import set_close_on_exec
 
 class ForkPtyProcessListener(object):
+    edge_triggered = True   # relay_all() reads until no data is pending
     def __init__(self, slave_pid, env):
         self.slave_pid = slave_pid
         self.env = env
@@ -17,8 +19,7 @@ class ForkPtyProcessListener(object):
     # the slave proces wrote something on its output
     # we just have to copy this to the user socket
     def handle_event(self, ts):
-        return read_and_copy(
-                self.env.slave_sock_file, self.env.client_sock_file)
+        return self.env.from_slave.relay_all()
     def end_child(self):
         try:
             os.kill(self.slave_pid, signal.SIGTERM)
@@ -27,7 +28,30 @@ class ForkPtyProcessListener(object):
         os.wait()   # wait for child's end
     def close(self):
         self.end_child()
-        self.env.close()
+        self.env.ev_loop.remove_listener(self.env)
+
+# Listeners must not be closed outside of the event loop (cf. evloop.py),
+# thus when a worker thread is involved (the thread waiting for the end
+# of the process in popen mode, or transfer threads, cf. transfer.py),
+# it does not close the client socket: it notifies the end of its work
+# through a WakeupFd, and the event loop removes the listener then.
+# If the event loop detects an error on the socket first, the socket is
+# just shut down (this unblocks the worker thread), and it is closed
+# when the worker thread ends.
+class WorkerEndListener(object):
+    def __init__(self, env):
+        self.env = env
+        self.wakeup = WakeupFd()
+    def fileno(self):
+        return self.wakeup.fileno()
+    # called by the worker thread
+    def notify(self):
+        self.wakeup.notify()
+    def handle_event(self, ts):
+        return False    # worker thread ended, remove this listener
+    def close(self):
+        self.wakeup.close()
+        self.env.worker_ended()
 
 class ParallelProcessSocketListener(object):
     def __init__(self, ev_loop, sock_file, **kwargs):
@@ -35,6 +59,10 @@ class ParallelProcessSocketListener(object):
         self.params = None
         self.client_sock_file = sock_file
         self.slave_sock_file = None
+        self.to_slave, self.from_slave = None, None
+        self.process_listener = None
+        self.worker_end = None
+        self.removed = False
         self.send_client('READY\n')
     def send_client(self, s):
         self.client_sock_file.write(s.encode('UTF-8'))
@@ -69,10 +97,12 @@ class ParallelProcessSocketListener(object):
         slave_r = os.fdopen(os.dup(fd_slave), 'rb', 0)
         slave_w = os.fdopen(os.dup(fd_slave), 'wb', 0)
         self.slave_sock_file = SmartFile(slave_r, slave_w)
+        self.to_slave = StreamRelay(self.client_sock_file, self.slave_sock_file)
+        self.from_slave = StreamRelay(self.slave_sock_file, self.client_sock_file)
         # create a new listener on the event loop for reading
         # what the slave process outputs
-        process_listener = ForkPtyProcessListener(slave_pid, self)
-        self.ev_loop.register_listener(process_listener)
+        self.process_listener = ForkPtyProcessListener(slave_pid, self)
+        self.ev_loop.register_listener(self.process_listener)
     def start_popen(self, cmd_args, env):
         # For efficiency, we let the popen object read directly from the socket.
         # Thus the ev_loop should not longer detect input data on this socket,
@@ -81,19 +111,29 @@ class ParallelProcessSocketListener(object):
         self.popen = Popen(cmd_args, env=env, bufsize=1024*1024,
                         stdin=self.client_sock_file, stdout=self.client_sock_file, stderr=STDOUT)
         set_close_on_exec(self.client_sock_file, True)
+        # when the process exits, the listener is removed, and the socket
+        # is closed in order to notify the end of transmission to the client.
+        self.start_worker(self.popen.wait)
+    # run target() in a worker thread.
+    # the event loop should only detect errors on the socket meanwhile.
+    def start_worker(self, target, *args, **kwargs):
         self.ev_loop.update_listener(self, 0)
-        self.popen_set_finalize_callback()
-    # when the popen object exits, close its output in order
-    # to notify the end of transmission to the client.
-    def popen_set_finalize_callback(self):
-        def monitor_popen(popen, client_sock_file):
-            popen.wait()
-            client_sock_file.close()
-            return
-        self.popen.monitor_thread = threading.Thread(
-                                target=monitor_popen,
-                                args=(self.popen, self.client_sock_file))
-        self.popen.monitor_thread.start()
+        worker_end = WorkerEndListener(self)
+        self.ev_loop.register_listener(worker_end)
+        self.worker_end = worker_end
+        def run_worker():
+            try:
+                target(*args, **kwargs)
+            finally:
+                worker_end.notify()
+        self.worker_thread = threading.Thread(target = run_worker)
+        self.worker_thread.start()
+    def worker_ended(self):
+        self.worker_end = None
+        if self.removed:
+            self.close_files()
+        else:
+            self.ev_loop.remove_listener(self)
     # let the event loop know what we are reading on
     def fileno(self):
         if self.client_sock_file.closed:
@@ -106,12 +146,10 @@ class ParallelProcessSocketListener(object):
             # we did not get the parameters yet, let's do it
             self.params = read_pickle(self.client_sock_file)
             if self.params == None:
-                self.close()    # issue
-                return False
+                return False    # issue, the listener will be removed
             self.update_params()
             if self.prepare(**self.params) == False:
-                self.close()    # issue
-                return False
+                return False    # issue, the listener will be removed
             self.params['cmd'] = self.get_command(**self.params)
             # we now have all info to start the child process
             self.start()
@@ -119,13 +157,30 @@ class ParallelProcessSocketListener(object):
             # otherwise we are all set. Thus, getting input data means
             # the user wrote something on the prompt (i.e. the socket)
             # we just have to copy this to the slave process input
-            return read_and_copy(
-                self.client_sock_file, self.slave_sock_file)
+            if self.to_slave is None:
+                return False    # popen mode, error on the socket
+            return self.to_slave.relay()
     def close(self):
+        self.removed = True
+        if self.worker_end is None:
+            self.close_files()
+        else:
+            try:
+                self.client_sock_file.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+    def close_files(self):
+        if self.process_listener is not None:
+            self.ev_loop.remove_listener(self.process_listener)
+            self.process_listener = None
         if self.client_sock_file:
             self.client_sock_file.close()
             self.client_sock_file = None
         if self.slave_sock_file:
             self.slave_sock_file.close()
             self.slave_sock_file = None
+        for relay in (self.to_slave, self.from_slave):
+            if relay is not None:
+                relay.close()
+        self.to_slave, self.from_slave = None, None
 
@@ -30,7 +30,7 @@ class Server(object):
         self.db = ServerDB()
         self.docker = DockerClient()
         self.blocking = BlockingTasksManager()
-        self.devices = DevicesManager(self.db)
+        self.devices = DevicesManager(self.db, self.device_renamed)
         self.topology = TopologyManager(self.devices, self.add_or_update_device)
         self.dhcpd = DHCPServer(self.db)
         self.images = NodeImageManager(self.db, self.blocking, self.dhcpd, self.docker)
@@ -39,7 +39,7 @@ class Server(object):
         self.interaction = InteractionManager(\
                         self.tcp_server, self.ev_loop)
         self.transfer = TransferManager(\
-                        self.tcp_server, self.ev_loop)
+                        self.tcp_server, self.ev_loop, self.images.store)
         self.nodes = NodesManager(  tcp_server = self.tcp_server,
                                     ev_loop = self.ev_loop,
                                     db = self.db,
@@ -54,6 +54,7 @@ class Server(object):
     def prepare(self):
         self.tcp_server.join_event_loop(self.ev_loop)
         self.db.plan_auto_commit(self.ev_loop)
+        self.db.plan_logs_maintenance(self.ev_loop)
         # ensure the dhcp server is running,
         # otherwise the switches may have ip addresses
         # outside the WalT network, and we will not be able
@@ -116,6 +117,9 @@ class Server(object):
         self.dhcpd.update()
         tftp.update(self.db)
 
+    def device_renamed(self, device_mac, new_name):
+        self.logs.rename_device(device_mac, new_name)
+
     def device_rescan(self, requester, remote_ip, device_set):
         devices = self.devices.parse_device_set(requester, device_set)
         if devices == None:
@@ -175,6 +179,10 @@ class Server(object):
                                   stream_ids = stream_ids,
                                   **kwargs)
 
+    # returns None if event loop stats are not enabled
+    def get_evloop_stats(self):
+        return self.ev_loop.get_stats()
+
     def image_shell_session_save(self, requester, session, new_name, name_confirmed):
         status = session.save(requester, new_name, name_confirmed)
         if status == 'OK_BUT_REBOOT_NODES':
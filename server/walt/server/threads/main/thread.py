@@ -1,12 +1,23 @@
 from walt.common.thread import EvThread
+from walt.server import conf
+from walt.server.conf import get_conf_option
 from walt.server.threads.main.network.setup import setup
 from walt.server.threads.main.server import Server
 from walt.server.threads.main.ui.manager import UIManager
 from walt.server.threads.main.hub import HubRPCThreadConnector
 
+# Event loop instrumentation (cf. 'walt advanced evloop-stats') may be
+# enabled in the "evloop" section of the server conf, e.g.
+# "evloop": { "stats": true, "slow-handler-threshold": 0.05 }
+EVLOOP_STATS = get_conf_option(conf, 'evloop', 'stats', False)
+EVLOOP_SLOW_HANDLER_THRESHOLD = get_conf_option(
+                        conf, 'evloop', 'slow-handler-threshold', 0.1)
+
 class ServerMainThread(EvThread):
     def __init__(self, tman):
         EvThread.__init__(self, tman, 'server-main')
+        if EVLOOP_STATS:
+            self.ev_loop.enable_stats(EVLOOP_SLOW_HANDLER_THRESHOLD)
         self.ui = UIManager()
         self.server = Server(self, self.ui)
         self.blocking = self.server.blocking
@@ -15,7 +26,7 @@ class ServerMainThread(EvThread):
     def prepare(self):
         self.server.prepare()
         self.register_listener(self.hub)
-        self.register_listener(self.blocking)
+        self.blocking.join_event_loop(self)
         setup(self.ui)
         self.notify_systemd()
         self.server.ui.set_status('Ready.')
@@ -1,8 +1,16 @@
 
+from concurrent.futures import ThreadPoolExecutor
+from subprocess import Popen, PIPE, STDOUT, run
+from walt.common.chunked import CHUNK_HEADER, CHUNK_SIZE, COMPRESSIONS, FINGERPRINT, \
+                                 decompress_chunk, check_chunk
+from walt.common.io import read_exactly, write_all
 from walt.common.tcp import Requests
+from walt.server.threads.main.images.filesystem import resolve_image_path
 from walt.server.threads.main.parallel import ParallelProcessSocketListener
+from walt.server import conf
+from walt.server.conf import get_conf_option
 from walt.server.const import SSH_COMMAND
-import os, random
+import errno, os, random, shlex, shutil, socket, tarfile, tempfile, threading, zlib
 
 TYPE_CLIENT = 0
 TYPE_IMAGE = 1
@@ -87,6 +95,7 @@ def validate_cp(image_or_node_label, caller,
                     "Could not reach %s. Try again later.\n" % image_tag_or_node)
                 return
             filesystems.append(filesystem)
+            entity_fs = filesystem
             paths.append(path.rstrip('/'))
     if len(operand_index_per_type) != 2:
         invalid = True
@@ -99,9 +108,10 @@ def validate_cp(image_or_node_label, caller,
     src_path, dst_path = [
             path if path.startswith('/') else './' + path
             for path in paths ]
-    info = analyse_file_types(  requester, image_tag_or_node,
-                                src_path, src_fs,
-                                dst_path, dst_fs)
+    with entity_fs:
+        info = analyse_file_types(  requester, image_tag_or_node,
+                                    src_path, src_fs,
+                                    dst_path, dst_fs)
     if info.pop('valid') == False:
         return
     # all seems fine
@@ -137,12 +147,336 @@ TarReceiveCommand='''\
         mv %(tmp_name)s %(dst_name)s && false || \
         rm -rf %(tmp_name)s '''
 
+TAR_BUFFER_SIZE = 1024 * 64
+
+class TarSocketWriter(object):
+    def __init__(self, sock_file):
+        self.sock_file = sock_file
+    def write(self, data):
+        write_all(self.sock_file, data)
+
+# add <path> of the image mounted at <root> to <archive>, following
+# symlinks (as 'tar c -h' in a container would do).
+def add_image_path(archive, root, path, arcname, parent_dirs = ()):
+    try:
+        host_path = resolve_image_path(root, path)
+        info = archive.gettarinfo(host_path, arcname)
+    except OSError:
+        return  # broken link or file removed
+    # user and group names of the server are irrelevant here
+    info.uname, info.gname = '', ''
+    if info.isreg():
+        with open(host_path, 'rb') as f:
+            archive.addfile(info, f)
+    elif info.isdir():
+        st = os.stat(host_path)
+        dir_id = (st.st_dev, st.st_ino)
+        if dir_id in parent_dirs:
+            return  # symlink loop
+        archive.addfile(info)
+        for name in sorted(os.listdir(host_path)):
+            add_image_path(archive, root, path + '/' + name, arcname + '/' + name,
+                           parent_dirs + (dir_id,))
+    else:
+        archive.addfile(info)
+
+def send_image_tar(mount, sock_file, src_dir, src_name, tmp_name, **params):
+    try:
+        with tarfile.open(mode='w|', fileobj=TarSocketWriter(sock_file),
+                          bufsize=TAR_BUFFER_SIZE) as archive:
+            add_image_path(archive, mount.mount_path,
+                           os.path.join(src_dir, src_name), tmp_name)
+    except (OSError, ValueError, tarfile.TarError):
+        pass    # client disconnected
+    finally:
+        mount.release()
+
+# The archive is generated in this process, with python tarfile, from a
+# private mount of the image (no container is needed).
+# It is written by a worker thread, thus the event loop is not blocked
+# during the transfer (cf. ParallelProcessSocketListener.start_worker()).
 class ImageTarSender(ParallelProcessSocketListener):
     REQ_ID = Requests.REQ_TAR_FROM_IMAGE
+    def __init__(self, images, **kwargs):
+        ParallelProcessSocketListener.__init__(self, **kwargs)
+        self.images = images
     def get_command(self, **params):
-        return docker_wrap_cmd(TarSendCommand) % params
+        return None
+    def start(self):
+        image = self.images[self.params['image_fullname']]
+        mount = image.private_mount()
+        self.start_worker(send_image_tar, mount, self.client_sock_file,
+                          **self.params)
+
+# interrupted (or finished) uploads are kept for this time (seconds),
+# waiting for the client to reconnect and resume the transfer (or get
+# its result).
+UPLOAD_RESUME_TIMEOUT = 120
+
+# Upload in chunked mode (cf. walt/common/chunked.py).
+# An upload is registered under its transfer_id for its whole lifetime.
+# The receiving process (e.g. ssh <node> tar x) is kept running when
+# the connection is lost, and it gets the data of the next connection
+# with the same transfer_id. This connection takes over the upload:
+# the previous socket is shut down (it may be half-open, with its
+# receiver thread still blocked reading it), and the new receiver thread
+# waits for the previous one to stop before resuming.
+# Chunks are received and decompressed by a worker thread, thus the
+# event loop is not blocked.
+class ChunkedUpload(object):
+    UPLOADS = {}    # transfer_id -> upload
+    LOCK = threading.Lock()
+
+    # called by the worker thread of a new connection.
+    # returns None if this upload just expired.
+    @staticmethod
+    def connect(transfer_id, sock_file, create_upload):
+        with ChunkedUpload.LOCK:
+            upload = ChunkedUpload.UPLOADS.get(transfer_id)
+            if upload is None:
+                upload = create_upload()
+                ChunkedUpload.UPLOADS[transfer_id] = upload
+            if upload.expired:
+                return None
+            previous_sock_file, upload.sock_file = upload.sock_file, sock_file
+            if upload.timer is not None:
+                upload.timer.cancel()
+                upload.timer = None
+        if previous_sock_file is not None:
+            try:
+                previous_sock_file.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+        return upload
+
+    def __init__(self, transfer_id, **params):
+        self.transfer_id = transfer_id
+        self.receiving_params = params
+        self.sock_file = None   # current connection
+        self.receiving = threading.Lock()   # held by the receiver thread
+        self.timer = None
+        self.expired = False
+        self.reset()
+
+    def reset(self):
+        self.offset = 0
+        self.crc = 0        # crc32 of the data written so far
+        self.result = None  # output of the receiving process, when ended
+        self.start_receiving(**self.receiving_params)
+
+    def start_receiving(self, cmd, **params):
+        # the output is only sent to the client at the end
+        self.output = tempfile.TemporaryFile()
+        self.popen = Popen(shlex.split(cmd), stdin = PIPE,
+                           stdout = self.output, stderr = STDOUT)
+
+    def write_chunk(self, chunk):
+        self.popen.stdin.write(chunk)
+
+    def receive(self, sock_file):
+        # wait for the receiver thread of the previous connection to stop
+        with self.receiving:
+            if self.sock_file is not sock_file:
+                return  # a newer connection already took over
+            try:
+                self.receive_chunks(sock_file)
+            except Exception:
+                pass    # connection lost or invalid data
+            self.suspend(sock_file)
+
+    def receive_chunks(self, sock_file):
+        sock_file.write(b'OFFSET %d %s\n' % (self.offset,
+                                    ','.join(COMPRESSIONS).encode('ascii')))
+        fingerprint = read_exactly(sock_file, FINGERPRINT.size)
+        if fingerprint is None:
+            return  # connection lost
+        if FINGERPRINT.unpack(fingerprint) != (self.offset, self.crc):
+            # the client did not generate the same archive as before
+            # (e.g. a file was modified): start again from scratch.
+            self.abort()
+            self.reset()
+            sock_file.write(b'RESTART\n')
+            return
+        if self.result is not None:
+            return self.finish(sock_file)   # the client missed the end
+        while True:
+            header = read_exactly(sock_file, CHUNK_HEADER.size)
+            if header is None:
+                return  # connection lost
+            offset, size, payload_size, crc, compression = \
+                        CHUNK_HEADER.unpack(header)
+            payload = read_exactly(sock_file, payload_size)
+            if payload is None or offset != self.offset or \
+                        compression >= len(COMPRESSIONS):
+                return
+            if size == 0:
+                self.result = self.end_process()
+                return self.finish(sock_file)   # end of transfer
+            chunk = decompress_chunk(COMPRESSIONS[compression], payload, size)
+            if not check_chunk(chunk, size, crc):
+                return  # corrupted chunk, the client will resume
+            try:
+                self.write_chunk(chunk)
+            except OSError:
+                # receiving process failed
+                self.result = self.end_process()
+                return self.finish(sock_file)
+            self.offset += size
+            self.crc = zlib.crc32(chunk, self.crc)
+            sock_file.write(b'ACK %d\n' % self.offset)
+
+    # the upload is kept for a while (the client may reconnect), then
+    # forgotten (cf. expire()).
+    def suspend(self, sock_file):
+        with ChunkedUpload.LOCK:
+            if self.sock_file is not sock_file:
+                return  # a newer connection took over
+            self.sock_file = None
+            self.timer = threading.Timer(UPLOAD_RESUME_TIMEOUT, self.expire)
+            self.timer.daemon = True
+            self.timer.start()
+
+    def expire(self):
+        with ChunkedUpload.LOCK:
+            if self.sock_file is not None:
+                return  # resumed meanwhile
+            self.expired = True
+        # keep the upload registered until the receiving process has
+        # cleaned up, thus a new upload with the same transfer_id cannot
+        # run at the same time.
+        if self.result is None:
+            self.abort()
+        with ChunkedUpload.LOCK:
+            del ChunkedUpload.UPLOADS[self.transfer_id]
+
+    def end_process(self):
+        try:
+            self.popen.stdin.close()
+        except OSError:
+            pass
+        self.popen.wait()
+        self.output.seek(0)
+        output = self.output.read()
+        self.output.close()
+        return output
+
+    def finish(self, sock_file):
+        sock_file.write(b'END %d\n' % len(self.result))
+        write_all(sock_file, self.result)
+        # the client may still be sending chunks: read them until it closes
+        # the connection, otherwise it may get a reset before reading
+        # the result.
+        while len(sock_file.read(CHUNK_SIZE)) > 0:
+            pass
+
+    def abort(self):
+        # the receiving process gets a truncated archive, thus it fails
+        # and removes what was extracted (cf. TarReceiveCommand)
+        self.end_process()
+
+def receive_upload(sock_file, transfer_id, create_upload):
+    upload = ChunkedUpload.connect(transfer_id, sock_file, create_upload)
+    if upload is not None:
+        upload.receive(sock_file)
+
+# maximum number of nodes receiving a broadcast upload at the same time.
+# This value may be set in the "transfer" section of the server conf.
+NODE_CP_PARALLELISM = get_conf_option(conf, 'transfer', 'node-cp-parallelism', 16)
+
+# Upload to a set of nodes (walt node cp <path> <node-set>:<path>).
+# The client sends the archive only once: it is spooled to a temporary
+# file in BROADCAST_SPOOL_DIR, and at the end of the transfer, each node
+# receives it with its own ssh process (at most NODE_CP_PARALLELISM at a
+# time).
+# The client announces the maximal size of the archive ('size' parameter):
+# the upload fails early if the server disk does not have this space,
+# plus BROADCAST_SPOOL_MIN_FREE bytes which are always kept free, and
+# if the archive exceeds this size.
+# The output sent to the client is a report with the status of each node.
+BROADCAST_SPOOL_DIR = '/var/lib/walt/spool'
+BROADCAST_SPOOL_MIN_FREE = 512 * 1024 * 1024
+
+class BroadcastUpload(ChunkedUpload):
+    def start_receiving(self, node_cmds, size = None, **params):
+        self.node_cmds = node_cmds      # ((node_name, cmd), ...)
+        self.spool = None
+        self.spool_size = 0
+        self.max_spool_size = size
+        self.spool_error = None
+        try:
+            os.makedirs(BROADCAST_SPOOL_DIR, exist_ok = True)
+            needed = BROADCAST_SPOOL_MIN_FREE
+            if size is not None:
+                needed += size
+            if shutil.disk_usage(BROADCAST_SPOOL_DIR).free < needed:
+                raise OSError(errno.ENOSPC, 'Not enough free space in %s' % \
+                                    BROADCAST_SPOOL_DIR)
+            self.spool = tempfile.NamedTemporaryFile(dir = BROADCAST_SPOOL_DIR)
+        except OSError as e:
+            self.spool_error = e
+
+    def write_chunk(self, chunk):
+        if self.spool_error is None:
+            self.spool_size += len(chunk)
+            if self.max_spool_size is not None and \
+                    self.spool_size > self.max_spool_size:
+                self.spool_error = OSError(errno.EFBIG,
+                                'Archive is larger than announced')
+        if self.spool_error is not None:
+            raise self.spool_error
+        try:
+            self.spool.write(chunk)
+        except OSError as e:
+            self.spool_error = e
+            raise
+
+    def send_to_node(self, node_cmd):
+        node_name, cmd = node_cmd
+        # each process reads the spool file with its own file offset
+        with open(self.spool.name, 'rb') as spool:
+            res = run(shlex.split(cmd), stdin = spool, stdout = PIPE, stderr = STDOUT)
+        output = res.stdout.decode('UTF-8', 'replace').strip()
+        # TarReceiveCommand only prints something on failure
+        if res.returncode == 0 and output == '':
+            return '%s: OK\n' % node_name
+        report = '%s: FAILED\n' % node_name
+        for line in output.splitlines():
+            report += '  %s\n' % line
+        return report
+
+    def end_process(self):
+        if self.spool_error is not None:
+            self.close_spool()
+            return ('Failed to store the archive on server: %s\n' % \
+                        self.spool_error).encode('UTF-8')
+        self.spool.flush()
+        with ThreadPoolExecutor(max_workers = NODE_CP_PARALLELISM) as pool:
+            reports = list(pool.map(self.send_to_node, self.node_cmds))
+        self.close_spool()
+        return ''.join(reports).encode('UTF-8')
+
+    def abort(self):
+        # nothing was sent to the nodes yet
+        self.close_spool()
+
+    def close_spool(self):
+        if self.spool is not None:
+            self.spool.close()      # this removes the file
+            self.spool = None
+
+class TarReceiver(ParallelProcessSocketListener):
+    def create_upload(self, **params):
+        return ChunkedUpload(**params)
+    def start(self):
+        if not self.params.get('chunked', False):
+            # older clients send a raw tar stream
+            return ParallelProcessSocketListener.start(self)
+        params = self.params
+        self.start_worker(receive_upload, self.client_sock_file,
+                          params['transfer_id'],
+                          lambda: self.create_upload(**params))
 
-class ImageTarReceiver(ParallelProcessSocketListener):
+class ImageTarReceiver(TarReceiver):
     REQ_ID = Requests.REQ_TAR_TO_IMAGE
     def get_command(self, **params):
         return docker_wrap_cmd(\
@@ -153,10 +487,16 @@ class NodeTarSender(ParallelProcessSocketListener):
     def get_command(self, **params):
         return ssh_wrap_cmd(TarSendCommand) % params
 
-class NodeTarReceiver(ParallelProcessSocketListener):
+class NodeTarReceiver(TarReceiver):
     REQ_ID = Requests.REQ_TAR_TO_NODE
     def get_command(self, **params):
         return ssh_wrap_cmd(TarReceiveCommand) % params
+    def create_upload(self, node_targets = (), **params):
+        if len(node_targets) < 2:
+            return TarReceiver.create_upload(self, **params)
+        node_cmds = tuple((node_name, self.get_command(**dict(params, node_ip = node_ip)))
+                          for node_name, node_ip in node_targets)
+        return BroadcastUpload(node_cmds = node_cmds, **params)
 
 class NodeFakeTFTPGet(ParallelProcessSocketListener):
     REQ_ID = Requests.REQ_FAKE_TFTP_GET
@@ -179,7 +519,9 @@ class NodeFakeTFTPGet(ParallelProcessSocketListener):
         return 'cat "%(full_path)s"' % params
 
 class TransferManager(object):
-    def __init__(self, tcp_server, ev_loop):
+    def __init__(self, tcp_server, ev_loop, images):
+        # remove spool files left by a previous run of the server
+        shutil.rmtree(BROADCAST_SPOOL_DIR, ignore_errors = True)
         for cls in [    ImageTarSender,
                         ImageTarReceiver,
                         NodeTarSender,
@@ -188,5 +530,6 @@ class TransferManager(object):
             tcp_server.register_listener_class(
                     req_id = cls.REQ_ID,
                     cls = cls,
-                    ev_loop = ev_loop)
+                    ev_loop = ev_loop,
+                    images = images)
 